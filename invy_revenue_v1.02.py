@@ -3,11 +3,25 @@ from PyQt5 import QtWidgets as qtw
 from PyQt5 import QtGui as qtg
 from PyQt5 import QtCore as qtc
 import pandas as pd
-import numpy as np
 import os
+import time
+
+from modules.allocation import allocate, prune_unmatched
+from modules.compact import compact_frame, format_bytes, frame_bytes
+from modules.db_source import db_columns, db_format, db_import
+from modules.export import export_format, export_lanes, export_shares
+from modules.import_file import file_format, load_files, template_columns
+from modules.incremental import changed_materials, splice_piece_prices, splice_shares
+from modules.keys import encode_keys, sum_duplicates
+from modules.material_cache import MaterialCache, allocate_cached
+from modules.optimal import allocate_optimal, load_lane_costs
+from modules.piece_price import piece_prices
+from modules.progress import Progress
+from modules.result_cache import ResultCache, file_fingerprint, run_key
+from modules.schema import ERROR_COLUMNS, STRAY_VALUE_ERROR, TEMPLATE_COLUMNS
+from modules.stream_import import stream_import
 
 # To-Do
-#  - Refactor "run_program" function
 #  - Add progress window when running program
 #  - Add threading to show window
 
@@ -20,6 +34,7 @@ class InvyCalculator(qtc.QObject):
     file_imported_signal = qtc.pyqtSignal(str, int)
     opps_remain = qtc.pyqtSignal(int, int)
     program_run_signal = qtc.pyqtSignal()
+    export_progress = qtc.pyqtSignal(int, int)
     template = pd.DataFrame(
         {
         'material': [],
@@ -29,9 +44,68 @@ class InvyCalculator(qtc.QObject):
         'bklg_val': []
         })
 
+    # Allocation engine used by run_program ("vectorized", "heap" or "optimal")
+    engine = "vectorized"
+
+    # Lane transfer costs for the "optimal" engine (.csv/.xlsx with need_plant,
+    # excess_plant & unit_cost columns)
+    lane_costs_file = None
+
+    # Worker processes used by run_program, split by material (1 runs in-process)
+    workers = 1
+
+    # Re-allocate only the materials that changed since the last run
+    incremental = True
+
+    # Memory budget in bytes for streaming imports of files too large to load
+    # whole, which sum duplicate plant/material rows (0 loads the whole file)
+    import_budget = 0
+
+    # Keep a memory-mappable copy of parsed excel & csv imports next to the
+    # source file, reused until the file is changed
+    import_cache = True
+
+    # Files parsed at once by a multi-file import (1 reads them in turn)
+    import_workers = min(4, os.cpu_count() or 1)
+
+    # Table or SELECT query read when a SQLite or DuckDB database file is
+    # imported, summed & split into needs and excess by the database itself
+    db_source = "inventory"
+
+    # Rows fetched at a time from a database import
+    db_batch_rows = 100000
+
+    # Folder for the on-disk caches
+    cache_dir = os.path.join(os.path.expanduser("~"), ".invy_revenue_cache")
+
+    # Size limit in bytes of the per-material allocation cache (0 turns it off)
+    material_cache_size = 256 * 2**20
+
+    # Size limit in bytes of the finished run cache (0 turns it off)
+    result_cache_size = 1 * 2**30
+
+    # Export format ("xlsx", "parquet", "csv" or "jsonl"; None picks it from
+    # the file extension)
+    export_as = None
+
+    # Lane files written at once by Export by Lane
+    export_workers = 4
+
+    # Store quantities in the smallest integer type that holds them exactly and
+    # drop working columns once used, for imports too big for memory otherwise
+    compact_dtypes = False
+
+    # Piece price precision in compact mode ("float64" or "float32")
+    price_dtype = "float64"
+
+    # Progress reports are coalesced to one per interval (seconds) or step (%)
+    progress_interval = 0.1
+    progress_step = 1
 
     def __init__(self):
         super().__init__()
+        self.last_run = None
+        self.import_errors = pd.DataFrame(columns=["File"] + ERROR_COLUMNS)
 
     def update_df(self, df, field):
         # Recalculate $ values
@@ -41,7 +115,7 @@ class InvyCalculator(qtc.QObject):
         df[field_val] = df[field] * df["piece_price"]
 
         # Sort & Return list
-        return df[df[field] > 0].sort_values(field_val, ascending=False)
+        return df[df[field] > 0].sort_values(field_val, ascending=False, kind="stable")
 
     def download_template(self):
         default_fn = str(qtc.QDir.currentPath()) + "/Inventory Revenue Template.xlsx"
@@ -75,25 +149,39 @@ class InvyCalculator(qtc.QObject):
 
 
     def import_file(self):
-        filename, _ = qtw.QFileDialog.getOpenFileName(
+        filenames, _ = qtw.QFileDialog.getOpenFileNames(
             None,
-            "Select an excel file to open...",
+            "Select one or more inventory files to open...",
             qtc.QDir.currentPath(),
             'All Files (*)'
             )
 
-        if filename:
-            # Check that file type is .xls or .xlsx
-            extension = filename.split(".")[-1]
+        if filenames:
+            # A single SQLite or DuckDB file is read through SQL
+            if len(filenames) == 1 and db_format(filenames[0]):
+                return self.import_database(filenames[0])
+
+            # Check that file types are excel, csv, parquet or feather
             self.share_status.emit("Checking extension...")
-            if extension not in ["xls", "xlsx"]:
-                error_msg = "ERROR: Please choose an excel file (*.xls, *.xlsx)."
+            if any(file_format(filename) is None for filename in filenames):
+                error_msg = "ERROR: Please choose excel, csv, parquet or feather files (*.xls, *.xlsx, *.csv, *.csv.gz, *.csv.zst, *.parquet, *.feather, *.arrow), or a single SQLite or DuckDB database (*.sqlite, *.db, *.duckdb)."
                 self.error_signal.emit("Import Error", error_msg)
                 return 3
 
-            self.share_status.emit("Reading file...")
+            # Several files show as the first one plus a count
+            filename = filenames[0]
+            if len(filenames) > 1:
+                filename += f" + {len(filenames) - 1} more"
+
+            if self.import_budget:
+                return self.import_streamed(filenames, filename)
+
+            # Files are read side by side, memory-mapping any with an import cache
+            self.share_status.emit(f"Reading {len(filenames):,} file(s)...")
             try:
-                self.raw_df = pd.read_excel(filename)
+                start = time.perf_counter()
+                loaded = load_files(filenames, self.import_workers, self.import_cache)
+                read_time = time.perf_counter() - start
             except PermissionError:
                 error_msg = "ERROR: Please close program before running script."
                 self.error_signal.emit("Permission Error", error_msg)
@@ -101,141 +189,398 @@ class InvyCalculator(qtc.QObject):
             except Exception as error:
                 self.error_signal.emit("Error", f"An upexpected error has occured: {error}")
                 return 2
+            rows = sum(len(df.index) for df, _, _, _, _ in loaded)
+            self.share_status.emit(
+                f"Read {rows:,} rows in {read_time:.2f}s ({rows / max(read_time, 1e-9):,.0f} rows/sec)."
+                )
 
-            # Check columns match template
+            # Check columns match template (only template columns are read)
             self.share_status.emit("Checking template...")
-            if list(self.raw_df.columns) != ['material', 'plant', 'invy', 'bklg_qty', 'bklg_val']:
-                error_msg = "ERROR: Columns do not match template. Please use correct template when uploading file."
-                self.error_signal.emit("File Template Error", error_msg)
-                return 3
-
-            # Clean DF
+            for name, (_, errors, _, _, _) in zip(filenames, loaded):
+                if errors is None:
+                    error_msg = f"ERROR: Columns of {os.path.basename(name)} do not match template. Please use correct template when uploading file."
+                    self.error_signal.emit("File Template Error", error_msg)
+                    return 3
+
+            # Rows that failed validation were left out, and are kept for the error report
+            self.import_errors = pd.concat(
+                [errors.assign(File=os.path.basename(name)) for name, (_, errors, _, _, _) in zip(filenames, loaded)],
+                ignore_index=True
+                )
+            self.report_import_errors()
+
+            frames = [df for df, _, _, _, _ in loaded]
+            self.raw_df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+            fingerprints = tuple(fingerprint for _, _, fingerprint, _, _ in loaded)
+            self.fingerprint = fingerprints[0] if len(fingerprints) == 1 else fingerprints
+
+            # Clean DF, coding plants & materials as integers
             self.share_status.emit("Cleaning dataframe...")
-            self.raw_df["plant_material"] = self.raw_df.plant.map(str) + "_" + self.raw_df.material.map(str)
-            self.raw_df = self.raw_df.set_index("plant_material")
-
-            # Create piece value lookup
-            self.piece_prices = self.calculate_piece_price(self.raw_df)
+            self.raw_df, self.plants, self.materials = encode_keys(self.raw_df)
+
+            # A plant & material can appear more than once (storage locations,
+            # several files), so sum them into one row per key
+            self.raw_df, merged = sum_duplicates(self.raw_df, len(self.materials))
+            self.share_status.emit(f"Merged {merged:,} duplicate plant/material rows.")
+
+            # Compact mode narrows quantities, dropping the key index nothing reads after this
+            self.memory_report = []
+            if self.compact_dtypes:
+                before = frame_bytes(self.raw_df)
+                self.raw_df = compact_frame(self.raw_df.reset_index(drop=True))
+                self.memory_report.append(("raw rows", before, frame_bytes(self.raw_df)))
+
+            # Diff against the last run's import, reusing prices of unchanged materials
+            self.changed = None
+            if self.incremental and self.last_run is not None and self.last_run["raw_df"] is not None:
+                self.share_status.emit("Comparing with last run...")
+                self.changed = changed_materials(
+                    self.last_run["raw_df"], self.last_run["plants"], self.last_run["materials"],
+                    self.raw_df, self.plants, self.materials
+                    )
+                self.piece_prices = splice_piece_prices(
+                    self.last_run["piece_prices"], self.last_run["materials"],
+                    self.raw_df, self.materials, self.changed
+                    )
+            else:
+                # Create piece value lookup
+                self.piece_prices = self.calculate_piece_price(self.raw_df)
 
-            # Setup Needs/Excess DF's
+            # Setup Needs/Excess DF's, in float so narrow quantities can't overflow
             self.share_status.emit("Creating needs and excess dataframes...")
-            self.raw_df["excess"] = self.raw_df["invy"] - self.raw_df["bklg_qty"]
-            self.raw_df["need"] = self.raw_df["bklg_qty"] - self.raw_df["invy"]
-            self.needs_df = self.raw_df[["material", "plant", "need"]]
-            self.needs_df = pd.merge(self.needs_df, self.piece_prices, on="material")
-            self.needs_df["plant_material"] = self.needs_df.plant.map(str) + "_" + self.needs_df.material.map(str)
-            self.needs_df = self.needs_df.set_index("plant_material")
+            need = self.raw_df["bklg_qty"].to_numpy(dtype=float) - self.raw_df["invy"].to_numpy(dtype=float)
+            keys = self.raw_df[["material", "plant"]]
+            self.finish_import(filename, keys.assign(need=need), keys.assign(excess=-need))
+
+    def import_streamed(self, filenames, filename):
+        # Large files are read in chunks within import_budget, keeping only
+        # the summed needs & excess, so there is no raw dataframe to diff
+        self.share_status.emit("Checking template...")
+        for name in filenames:
+            try:
+                columns = template_columns(name)
+            except Exception as error:
+                self.error_signal.emit("Error", f"An upexpected error has occured: {error}")
+                return 2
+            if columns != TEMPLATE_COLUMNS:
+                error_msg = f"ERROR: Columns of {os.path.basename(name)} do not match template. Please use correct template when uploading file."
+                self.error_signal.emit("File Template Error", error_msg)
+                return 3
 
-            self.excess_df = self.raw_df[["material", "plant", "excess"]]
-            self.excess_df = pd.merge(self.excess_df, self.piece_prices, on="material")
-            self.excess_df["plant_material"] = self.excess_df.plant.map(str) + "_" + self.excess_df.material.map(str)
-            self.excess_df = self.excess_df.set_index("plant_material")
+        self.share_status.emit(f"Streaming {len(filenames):,} file(s)...")
+        try:
+            start = time.perf_counter()
+            needs_df, excess_df, self.plants, self.materials, self.piece_prices, rows, self.import_errors = stream_import(
+                filenames, self.import_budget, os.path.join(self.cache_dir, "spill"), self.share_status.emit
+                )
+            read_time = time.perf_counter() - start
+            fingerprints = tuple(file_fingerprint(name) for name in filenames)
+            self.fingerprint = fingerprints[0] if len(fingerprints) == 1 else fingerprints
+        except PermissionError:
+            error_msg = "ERROR: Please close program before running script."
+            self.error_signal.emit("Permission Error", error_msg)
+            return 1
+        except Exception as error:
+            self.error_signal.emit("Error", f"An upexpected error has occured: {error}")
+            return 2
+        self.share_status.emit(
+            f"Streamed {rows:,} rows in {read_time:.2f}s ({rows / max(read_time, 1e-9):,.0f} rows/sec)."
+            )
+        self.report_import_errors()
+
+        self.raw_df = None
+        self.changed = None
+        self.memory_report = []
+        self.finish_import(filename, needs_df, excess_df)
+
+    def import_database(self, filename):
+        # The database validates, merges duplicates, sums backlog per material
+        # and splits needs from excess, so only the split rows are fetched
+        self.share_status.emit("Checking template...")
+        try:
+            columns = db_columns(filename, self.db_source)
+        except Exception as error:
+            self.error_signal.emit("Error", f"Could not read {self.db_source} from {os.path.basename(filename)}: {error}")
+            return 2
+        if columns != TEMPLATE_COLUMNS:
+            error_msg = f"ERROR: Columns of {self.db_source} in {os.path.basename(filename)} do not match template. Please use correct template when uploading file."
+            self.error_signal.emit("File Template Error", error_msg)
+            return 3
+
+        self.share_status.emit(f"Querying {os.path.basename(filename)}...")
+        try:
+            start = time.perf_counter()
+            needs_df, excess_df, self.plants, self.materials, self.piece_prices, rows, errors = db_import(
+                filename, self.db_source, self.db_batch_rows, self.share_status.emit
+                )
+            read_time = time.perf_counter() - start
+            self.fingerprint = (file_fingerprint(filename), self.db_source)
+        except PermissionError:
+            error_msg = "ERROR: Please close program before running script."
+            self.error_signal.emit("Permission Error", error_msg)
+            return 1
+        except Exception as error:
+            self.error_signal.emit("Error", f"An upexpected error has occured: {error}")
+            return 2
+        self.share_status.emit(
+            f"Queried {rows:,} rows in {read_time:.2f}s ({rows / max(read_time, 1e-9):,.0f} rows/sec)."
+            )
+        self.import_errors = errors.assign(File=os.path.basename(filename))
+        self.report_import_errors()
+
+        self.raw_df = None
+        self.changed = None
+        self.memory_report = []
+        self.finish_import(filename, needs_df, excess_df)
+
+    def report_import_errors(self):
+        if len(self.import_errors.index):
+            # Rows with only a stray backlog value are kept, so aren't skipped
+            skipped = self.import_errors[self.import_errors["Error"] != STRAY_VALUE_ERROR]
+            rows = skipped[["File", "Row"]].drop_duplicates()
+            self.share_status.emit(
+                f"Skipped {len(rows.index):,} rows, found {len(self.import_errors.index):,} problems. See Tools > Save Import Errors."
+                )
+
+    def save_import_errors(self):
+        default_fn = str(qtc.QDir.currentPath()) + "/Import Errors.csv"
+        filename, _ = qtw.QFileDialog.getSaveFileName(
+            None,
+            "Save File",
+            default_fn,
+            'CSV (*.csv);;All Files (*)'
+            )
+        if filename:
+            try:
+                self.import_errors[["File"] + ERROR_COLUMNS].to_csv(filename, index=False)
+                self.share_status.emit(f"Saved {len(self.import_errors.index):,} import errors.")
+            except Exception as error:
+                self.error_signal.emit("Error", str(error))
+
+    def finish_import(self, filename, needs_df, excess_df):
+        # Price, sort & prune the needs and excess rows of a new import
+        if self.compact_dtypes:
+            self.piece_prices = self.piece_prices.astype(self.price_dtype)
+        raw_price = self.piece_prices[needs_df["material"].to_numpy()]
+        self.needs_df = needs_df.assign(piece_price=raw_price)
+        self.excess_df = excess_df.assign(piece_price=self.piece_prices[excess_df["material"].to_numpy()])
+
+        # Update the needs & excess dataframes
+        self.share_status.emit("Updating dataframes...")
+        self.needs_df = self.update_df(self.needs_df, "need")
+        self.excess_df = self.update_df(self.excess_df, "excess")
+
+        # Only materials with both needs and excess are worth allocating
+        self.share_status.emit("Pruning unmatched materials...")
+        self.needs_df, self.excess_df, needs_pruned, excess_pruned = prune_unmatched(
+            self.needs_df, self.excess_df, len(self.materials)
+            )
+        self.share_status.emit(
+            f"Pruned {needs_pruned:,} needs and {excess_pruned:,} excess rows with no matching material."
+            )
 
-            # Update the needs & excess dataframes
-            self.share_status.emit("Updating dataframes...")
-            self.needs_df = self.update_df(self.needs_df, "need")
-            self.excess_df = self.update_df(self.excess_df, "excess")
+        # The engines only read codes & quantities, so compact mode drops the
+        # sort columns and index once the rows are in order
+        if self.compact_dtypes:
+            before = frame_bytes(self.needs_df) + frame_bytes(self.excess_df)
+            self.needs_df = compact_frame(self.needs_df[["material", "plant", "need"]].reset_index(drop=True))
+            self.excess_df = compact_frame(self.excess_df[["material", "plant", "excess"]].reset_index(drop=True))
+            self.memory_report.append(("needs & excess", before, frame_bytes(self.needs_df) + frame_bytes(self.excess_df)))
+            self.share_status.emit("Memory: " + ", ".join(
+                f"{stage} {format_bytes(before)} -> {format_bytes(after)}" for stage, before, after in self.memory_report
+                ) + ".")
 
-            opportunities = len(self.needs_df.index)
-            self.file_imported_signal.emit(filename, opportunities)
-            self.share_status.emit("File imported successfully.")
+        opportunities = len(self.needs_df.index)
+        self.file_imported_signal.emit(filename, opportunities)
+        self.share_status.emit("File imported successfully.")
 
 
     def calculate_piece_price(self, df):
         self.share_status.emit("Calculating piece prices...")
-        pp_df = pd.pivot_table(df, index=["material"], values = ["bklg_qty", "bklg_val"], aggfunc=np.sum)
-        pp_df["piece_price"] = pp_df["bklg_val"] / pp_df["bklg_qty"]
-        pp_df = pp_df.drop(["bklg_qty", "bklg_val"], axis=1)
-        pp_df["piece_price"] = pp_df["piece_price"].replace([np.inf], 0)
-        return pp_df
+        return piece_prices(df["material"].to_numpy(), df["bklg_qty"], df["bklg_val"], len(self.materials))
 
     def run_program(self):
+        # Options that change the results
+        options = (self.engine, self.lane_costs_file, self.piece_prices.dtype.str)
+        lane_costs = None
+        if self.engine == "optimal":
+            if not self.lane_costs_file:
+                error_msg = "ERROR: Please choose a lane cost file before running the optimal engine."
+                self.error_signal.emit("Lane Cost Error", error_msg)
+                return 1
 
-        # Loop through every plant/PN combo under "needs"
-        self.shares = pd.DataFrame(columns = ["PN", "Needs Plant", "Excess Plant", "Share Qty", "Share Value"])
-        self.share_status.emit("Checking records...")
-
-        while True:
-            # Check if needs DF is empty
-            if self.needs_df.empty:
-                break
-
-            # Break out top PN/Plant/Qty from needs
-            n_pn = self.needs_df.iloc[0]["material"]
-            n_plant = self.needs_df.iloc[0]["plant"]
-            n_qty = self.needs_df.iloc[0]["need"]
-            self.excess_df_sel = self.excess_df[self.excess_df["material"] == n_pn]
-            
-            # Check if excess sub-df (for 1st PN) is empty
-            if self.excess_df_sel.empty:
-                self.needs_df = self.needs_df[self.needs_df["material"] != n_pn] # Remove 
-                self.needs_df = self.update_df(self.needs_df, "need")
-
-                needs_left = len(self.needs_df.index)
-                revenue_gen = int(self.shares["Share Value"].sum())
-                self.opps_remain.emit(needs_left, revenue_gen)
-                continue
-            else:
-                # Get the plant/qty with the highest stock of the needed PN
-                e_plant = self.excess_df_sel.iloc[0]["plant"]
-                e_qty = self.excess_df_sel.iloc[0]["excess"]
-
-                # If the excess plant has more than enough, share what's needed
-                if e_qty > n_qty:
-                    # Make note of how much can be shared between plants
-                    share_qty = n_qty
-
-                    # Update values in needs/excess df's
-                    self.excess_df.at[(str(e_plant) + "_" + n_pn), "excess"] = int(e_qty) - int(n_qty) # Subtract shared qty from excess DF
-                    self.needs_df.at[str(n_plant) + "_" + n_pn, "need"] = 0 # Set needs qty to zero, as all needs have been sent
-
-                # If the excess plant doesn't have enough, share everything
-                else:
-                    # Make note of how much can be shared between plants
-                    share_qty = e_qty
-
-                    # Update values in needs/excess df's
-                    self.excess_df.at[(str(e_plant) + "_" + n_pn), "excess"] = 0 # Take all of the excess stock
-                    self.needs_df.at[str(n_plant) + "_" + n_pn, "need"] = int(n_qty) - int(e_qty) # Subtract needs qty from needs df
-
-                # Make note of how much can be shared between plants
-                share_val = share_qty * self.piece_prices["piece_price"][n_pn]
-                n_plant_e_plant_pn = str(n_plant) + "-" + str(e_plant) + "-" + str(n_pn)
-                new_row = [n_pn, str(n_plant), str(e_plant), share_qty, share_val]
-
-                self.shares.loc[len(self.shares.index)] = new_row
-
-                # Update df's
-                self.excess_df = self.update_df(self.excess_df, "excess")
-                self.needs_df = self.update_df(self.needs_df, "need")
+            try:
+                lane_costs = load_lane_costs(self.lane_costs_file, self.plants)
+                options += (file_fingerprint(self.lane_costs_file),)
+            except Exception as error:
+                self.error_signal.emit("Lane Cost Error", f"ERROR: Could not load lane costs: {error}")
+                return 2
 
-                # Emit progress
-                needs_left = len(self.needs_df.index)
-                revenue_gen = int(self.shares["Share Value"].sum())
-                self.opps_remain.emit(needs_left, revenue_gen)
+        progress = Progress(
+            len(self.needs_df.index), self.emit_progress, self.progress_interval, self.progress_step
+            )
 
-        # Sort opportunities by highest $ value, filter for >0 $ value
-        self.share_status.emit("Finalizing opportunities...")
-        self.shares = self.shares[self.shares["Share Value"] > 0].sort_values("Share Value", ascending=False)
+        # Re-running an identical input with the same options reuses the result
+        shares = None
+        result_cache = None
+        if self.result_cache_size:
+            result_key = run_key(self.fingerprint, options)
+            try:
+                result_cache = ResultCache(os.path.join(self.cache_dir, "results"), self.result_cache_size)
+                shares = result_cache.get(result_key)
+            except Exception as error:
+                # The cache is optional, so a folder that can't be used only means allocating
+                self.share_status.emit(f"Result cache unavailable: {error}")
+
+        if shares is not None:
+            self.share_status.emit("Loaded results of an identical run from cache.")
+            progress.add(0, shares["Share Value"].sum())
+        else:
+            shares = self.allocate_shares(progress, options, lane_costs)
+            if result_cache is not None:
+                try:
+                    result_cache.put(result_key, shares)
+                except Exception as error:
+                    self.share_status.emit(f"Results could not be cached: {error}")
+        self.shares = shares
+        progress.finish()
+
+        # Keep this run to diff the next import against
+        self.last_run = {
+            "raw_df": self.raw_df,
+            "plants": self.plants,
+            "materials": self.materials,
+            "piece_prices": self.piece_prices,
+            "shares": self.shares,
+            "options": options
+            }
+        self.changed = None
 
         # Signal that program has run successfully
         self.share_status.emit("Program complete.")
         self.program_run_signal.emit()
 
+    def allocate_shares(self, progress, options, lane_costs):
+        # After a small change, only the changed materials need allocating
+        needs_df, excess_df = self.needs_df, self.excess_df
+        incremental = self.changed is not None and self.last_run["options"] == options
+        if incremental:
+            self.share_status.emit(f"Re-allocating {len(self.changed):,} changed materials...")
+            dirty = self.materials.isin(self.changed)
+            needs_df = needs_df[dirty[needs_df["material"].to_numpy()]]
+            excess_df = excess_df[dirty[excess_df["material"].to_numpy()]]
+            kept = self.last_run["shares"]["PN"].isin(self.changed)
+            progress.add(len(self.needs_df.index) - len(needs_df.index), self.last_run["shares"]["Share Value"][~kept].sum())
+        else:
+            # Match every need against the excess of the same material in one pass
+            self.share_status.emit("Allocating excess inventory...")
+
+        cache = None
+        if self.engine != "optimal" and self.material_cache_size:
+            cache = self.open_material_cache()
+
+        if self.engine == "optimal":
+            shares = allocate_optimal(
+                needs_df, excess_df, self.piece_prices, self.plants, self.materials,
+                lane_costs, self.workers, progress
+                )
+        elif cache is not None:
+            try:
+                shares = allocate_cached(
+                    cache, needs_df, excess_df, self.piece_prices, self.plants, self.materials,
+                    self.engine, self.workers, progress
+                    )
+            finally:
+                cache.close()
+            if cache.error is not None:
+                self.share_status.emit(f"Material cache unavailable, allocated without it: {cache.error}")
+        else:
+            shares = allocate(
+                needs_df, excess_df, self.piece_prices, self.plants, self.materials,
+                self.engine, self.workers, progress
+                )
+
+        if incremental:
+            shares = splice_shares(self.last_run["shares"], shares, self.changed)
+        return shares
+
+    def open_material_cache(self):
+        # The cache is optional, so a folder or file that can't be opened
+        # only means allocating without it
+        try:
+            return MaterialCache(os.path.join(self.cache_dir, "materials.sqlite"), self.material_cache_size)
+        except Exception as error:
+            self.share_status.emit(f"Material cache unavailable, allocating without it: {error}")
+            return None
+
+    def purge_caches(self):
+        try:
+            ResultCache(os.path.join(self.cache_dir, "results")).purge()
+            cache = MaterialCache(os.path.join(self.cache_dir, "materials.sqlite"))
+            try:
+                cache.clear()
+            finally:
+                cache.close()
+        except Exception as error:
+            self.error_signal.emit("Cache Error", f"ERROR: Could not clear the caches: {error}")
+            return 1
+        self.share_status.emit("Caches cleared.")
+
+    def emit_progress(self, needs_left, revenue_gen):
+        self.opps_remain.emit(needs_left, int(revenue_gen))
+
     def export_file(self):
         default_fn = str(qtc.QDir.currentPath()) + "/Inventory Revenue Opportunities.xlsx"
         filename, _ = qtw.QFileDialog.getSaveFileName(
             None,
             "Save File",
             default_fn,
-            'Microsoft Excel Workbook (*.xlsx);;Text Files (*.txt);;All Files (*)'
+            'Microsoft Excel Workbook (*.xlsx);;Parquet (*.parquet);;CSV (*.csv);;JSON Lines (*.jsonl);;All Files (*)'
             )
         if filename:
+            fmt = self.export_as or export_format(filename)
+            if fmt is None:
+                error_msg = "ERROR: Please export to an excel, parquet, csv or json lines file (*.xlsx, *.parquet, *.csv, *.jsonl)."
+                self.error_signal.emit("Export Error", error_msg)
+                return 3
+
+            # Rows are streamed out in chunks, reporting rows written as they go
+            self.share_status.emit("Exporting shares...")
+            total = len(self.shares.index)
+            progress = Progress(
+                total, lambda rows_left, _: self.export_progress.emit(total - rows_left, total),
+                self.progress_interval, self.progress_step
+                )
             try:
-                self.shares.to_excel(filename, index=False)
-                os.startfile(filename)
+                export_shares(self.shares, filename, fmt, progress)
+                progress.finish()
+                self.share_status.emit(f"Exported {total:,} shares.")
+                if fmt == "xlsx":
+                    os.startfile(filename)
             except Exception as error:
-                self.error_signal.emit("Error", error)
+                self.error_signal.emit("Error", str(error))
+
+    def export_lanes(self):
+        folder = qtw.QFileDialog.getExistingDirectory(
+            None,
+            "Select a folder for the lane files...",
+            qtc.QDir.currentPath()
+            )
+        if folder:
+            # One file per needs plant & excess plant lane, plus a manifest
+            fmt = self.export_as or "xlsx"
+            self.share_status.emit("Exporting shares by lane...")
+            total = len(self.shares.index)
+            progress = Progress(
+                total, lambda rows_left, _: self.export_progress.emit(total - rows_left, total),
+                self.progress_interval, self.progress_step
+                )
+            try:
+                manifest = export_lanes(self.shares, folder, fmt, self.export_workers, progress)
+                progress.finish()
+                self.share_status.emit(f"Exported {total:,} shares to {len(manifest.index):,} lane files.")
+            except Exception as error:
+                self.error_signal.emit("Error", str(error))
 
 
 class MainWindow(qtw.QMainWindow):
@@ -249,6 +594,7 @@ class MainWindow(qtw.QMainWindow):
         self.calculator.opps_remain.connect(self.update_progress)
         self.calculator.program_run_signal.connect(self.program_run)
         self.calculator.share_status.connect(self.update_status)
+        self.calculator.export_progress.connect(self.update_export_progress)
 
         # Create threading
         self.calc_thread = qtc.QThread()
@@ -350,6 +696,13 @@ class MainWindow(qtw.QMainWindow):
         self.footer_label.setAlignment(qtc.Qt.AlignCenter)
         self.main.layout().addWidget(self.footer_label, 10, 0, 1, 2)
 
+        # Tools menu
+        self.tools_menu = self.menuBar().addMenu("Tools")
+        self.tools_menu.addAction("Clear Cache", self.calculator.purge_caches)
+        self.tools_menu.addAction("Save Import Errors...", self.calculator.save_import_errors)
+        self.export_lanes_action = self.tools_menu.addAction("Export by Lane...", self.calculator.export_lanes)
+        self.export_lanes_action.setDisabled(True)
+
         # Status bar
         self.status_bar = qtw.QStatusBar()
         self.setStatusBar(self.status_bar)
@@ -430,6 +783,7 @@ class MainWindow(qtw.QMainWindow):
         self.import_btn.setText(filename_short)
         self.run_btn.setDisabled(False)
         self.export_btn.setDisabled(True)
+        self.export_lanes_action.setDisabled(True)
         self.progress_bar.setValue(0)
 
         self.opportunities = opps
@@ -446,7 +800,7 @@ class MainWindow(qtw.QMainWindow):
     def update_progress(self, n_remain, rev_gen):
         # Update progress through opp's
         n_done = self.opportunities - n_remain
-        perc_done = int(100 * (n_done / self.opportunities))
+        perc_done = int(100 * (n_done / self.opportunities)) if self.opportunities else 100
         progress_str = "Opportunities Searched: "
         progress_str += "{:,}".format(n_done) + " / "
         progress_str += "{:,}".format(self.opportunities)
@@ -459,11 +813,17 @@ class MainWindow(qtw.QMainWindow):
         rev_gen_msg = "Revenue Found: " + rev_gen_str
         self.revenue_label.setText(rev_gen_msg)
 
+    def update_export_progress(self, rows_done, rows_total):
+        perc_done = int(100 * (rows_done / rows_total)) if rows_total else 100
+        self.progress_bar.setValue(perc_done)
+        self.status_bar.showMessage("Exported " + "{:,}".format(rows_done) + " / " + "{:,}".format(rows_total) + " shares...")
+
     def update_status(self, msg):
         self.status_bar.showMessage(msg)
 
     def program_run(self):
         self.export_btn.setDisabled(False)
+        self.export_lanes_action.setDisabled(False)
         self.run_btn.setDisabled(True)
 
         # Display results
@@ -0,0 +1,314 @@
+import heapq
+import pandas as pd
+import numpy as np
+
+from modules.parallel import allocate_parallel
+
+SHARE_COLUMNS = ["PN", "Needs Plant", "Excess Plant", "Share Qty", "Share Value"]
+
+# Bump whenever a change to the engines changes their results, so cached
+# allocations from older versions are ignored
+ENGINE_VERSION = 1
+
+def allocate(needs_df, excess_df, price, plants, materials, engine="vectorized", workers=1, progress=None):
+	'''
+	Matches every need against the excess inventory of the same material.
+	Every engine follows the same greedy rule as the original loop: the largest
+	remaining need is always filled from the largest remaining excess plant.
+	Takes 8 inputs:
+		needs_df - Dataframe with "material", "plant" & "need"
+		excess_df - Dataframe with "material", "plant" & "excess"
+		price - Piece price, indexed by material code
+		plants - Plant labels, indexed by plant code
+		materials - Material labels, indexed by material code
+		engine - Name of the allocation engine (see ENGINES)
+		workers - Number of worker processes (1 runs in this process)
+		progress - Optional Progress to report needs searched & revenue to
+	Returns the shares dataframe, sorted by share value descending.
+	'''
+	n_row, e_row, qty = allocate_rows(needs_df, excess_df, price, engine, workers, progress)
+	return build_shares(needs_df, excess_df, price, plants, materials, n_row, e_row, qty)
+
+def allocate_rows(needs_df, excess_df, price, engine="vectorized", workers=1, progress=None):
+	'''
+	Runs an allocation engine on the needs & excess dataframes.
+	Takes 6 inputs:
+		needs_df - Dataframe with "material" & "need"
+		excess_df - Dataframe with "material" & "excess"
+		price - Piece price, indexed by material code
+		engine - Name of the allocation engine (see ENGINES)
+		workers - Number of worker processes (1 runs in this process)
+		progress - Optional Progress to report needs searched & revenue to
+	Returns (need row, excess row, share qty) arrays, one entry per share.
+	'''
+	n_mat = needs_df["material"].to_numpy()
+	e_mat = excess_df["material"].to_numpy()
+	n_qty = needs_df["need"].to_numpy(dtype=float)
+	e_qty = excess_df["excess"].to_numpy(dtype=float)
+	price = np.asarray(price, dtype=float)
+
+	if workers > 1:
+		return allocate_parallel(ENGINES[engine], n_mat, n_qty, e_mat, e_qty, price, workers, progress)
+	return ENGINES[engine](n_mat, n_qty, e_mat, e_qty, price, progress)
+
+def build_shares(needs_df, excess_df, price, plants, materials, n_row, e_row, qty, cost=None):
+	'''
+	Turns engine output into the shares dataframe, sorted by share value with
+	ties by need row then excess row, so every engine returns the same table
+	for the same shares.
+	Takes 9 inputs:
+		needs_df, excess_df - Dataframes the engine ran on
+		price - Piece price, indexed by material code
+		plants, materials - Plant & material labels, indexed by code
+		n_row, e_row, qty - Need row, excess row & quantity of each share
+		cost - Optional transfer cost of each share, added as "Transfer Cost"
+	Returns the shares dataframe.
+	'''
+	n_mat = needs_df["material"].to_numpy()
+	value = qty * np.asarray(price, dtype=float)[n_mat[n_row]]
+	order = np.lexsort((e_row, n_row, -value))
+
+	shares = pd.DataFrame({
+		"PN": np.asarray(materials)[n_mat[n_row[order]]],
+		"Needs Plant": np.asarray(plants)[needs_df["plant"].to_numpy()[n_row[order]]].astype(str),
+		"Excess Plant": np.asarray(plants)[excess_df["plant"].to_numpy()[e_row[order]]].astype(str),
+		"Share Qty": qty[order],
+		"Share Value": value[order]
+		}, columns=SHARE_COLUMNS)
+	if cost is not None:
+		shares["Transfer Cost"] = cost[order]
+	return shares
+
+def prune_unmatched(needs_df, excess_df, n_materials):
+	'''
+	Semi-joins needs & excess on material, dropping rows for materials that
+	only appear on one side, since they can never generate a share.
+	Takes 3 inputs:
+		needs_df - Dataframe of needs with a coded "material" column
+		excess_df - Dataframe of excess with a coded "material" column
+		n_materials - Number of material codes
+	Returns (needs_df, excess_df, needs pruned, excess pruned).
+	'''
+	n_mat = needs_df["material"].to_numpy()
+	e_mat = excess_df["material"].to_numpy()
+	on_both = (np.bincount(n_mat, minlength=n_materials) > 0) & (np.bincount(e_mat, minlength=n_materials) > 0)
+
+	keep_needs = on_both[n_mat]
+	keep_excess = on_both[e_mat]
+	return (
+		needs_df[keep_needs], excess_df[keep_excess],
+		int((~keep_needs).sum()), int((~keep_excess).sum())
+		)
+
+def allocate_codes(n_mat, n_qty, e_mat, e_qty, price, progress=None):
+	'''
+	Array version of the allocation. Materials where one side has a single
+	plant are solved in closed form with cumulative sums; the rest are played
+	out with the greedy rule one material at a time.
+	Takes 6 inputs:
+		n_mat, n_qty - Material code & need quantity for each needs row
+		e_mat, e_qty - Material code & excess quantity for each excess row
+		price - Piece price, indexed by material code
+		progress - Optional Progress to report needs searched & revenue to
+	Returns (need row, excess row, share qty) arrays, one entry per share.
+	'''
+	n_materials = len(price)
+	n_rows, n_cnt = _sort_groups(n_mat, n_qty, price, n_materials)
+	e_rows, e_cnt = _sort_groups(e_mat, e_qty, price, n_materials)
+
+	# Only materials with both needs and excess can generate shares
+	active = (n_cnt > 0) & (e_cnt > 0)
+	n_rows = n_rows[active[n_mat[n_rows]]]
+	e_rows = e_rows[active[e_mat[e_rows]]]
+	n_sorted = n_mat[n_rows]
+	e_sorted = e_mat[e_rows]
+
+	one_need = active & (n_cnt == 1)
+	one_excess = active & (e_cnt == 1) & (n_cnt > 1)
+	many = active & (n_cnt > 1) & (e_cnt > 1)
+
+	shares = ShareBuffer(len(n_rows) + len(e_rows))
+	if progress:
+		progress.add(len(n_mat) - len(n_rows))
+
+	# Single need: drain excess plants largest first until the need is met
+	sel = one_need[e_sorted]
+	if sel.any():
+		rows = e_rows[sel]
+		need_rows = n_rows[np.searchsorted(n_sorted, e_sorted[sel])]
+		qty = np.clip(n_qty[need_rows] - _prior(e_sorted[sel], e_qty[rows]), 0, e_qty[rows])
+		shares.extend(need_rows[qty > 0], rows[qty > 0], qty[qty > 0])
+		if progress:
+			progress.add(one_need.sum(), (qty * price[e_sorted[sel]]).sum())
+
+	# Single excess plant: fill needs largest first until the excess runs out
+	sel = one_excess[n_sorted]
+	if sel.any():
+		rows = n_rows[sel]
+		excess_rows = e_rows[np.searchsorted(e_sorted, n_sorted[sel])]
+		qty = np.clip(e_qty[excess_rows] - _prior(n_sorted[sel], n_qty[rows]), 0, n_qty[rows])
+		shares.extend(rows[qty > 0], excess_rows[qty > 0], qty[qty > 0])
+		if progress:
+			progress.add(len(rows), (qty * price[n_sorted[sel]]).sum())
+
+	# Several plants on both sides: residuals re-rank, so play out the greedy rule.
+	# Each material's rows are sliced by group offsets, since only active
+	# materials are left in the sorted rows
+	n_start = np.concatenate(([0], np.cumsum(np.where(active, n_cnt, 0))))
+	e_start = np.concatenate(([0], np.cumsum(np.where(active, e_cnt, 0))))
+	for m in np.flatnonzero(many).tolist():
+		n_grp = np.sort(n_rows[n_start[m]:n_start[m + 1]])
+		e_grp = np.sort(e_rows[e_start[m]:e_start[m + 1]])
+		shared = _greedy_group(n_grp, e_grp, n_qty, e_qty, shares)
+		if progress:
+			progress.add(len(n_grp), shared * price[m])
+
+	return shares.arrays()
+
+def _sort_groups(mat, qty, price, n_materials):
+	# Shares for materials without a positive piece price are dropped at the
+	# end anyway, so skip them along with the empty rows
+	rows = np.flatnonzero((qty > 0) & (price[mat] > 0))
+
+	# Group by material, largest quantity first, ties in original row order
+	rows = rows[np.lexsort((rows, -qty[rows], mat[rows]))]
+	return rows, np.bincount(mat[rows], minlength=n_materials)
+
+def _prior(mat, qty):
+	# Quantity ahead of each row within its own (sorted) material group
+	cum = np.cumsum(qty)
+	start = np.searchsorted(mat, mat)
+	return cum - qty - (cum[start] - qty[start])
+
+def _greedy_group(n_grp, e_grp, n_qty, e_qty, shares):
+	'''
+	Plays out the greedy rule for a single material. Rows are in original
+	order, so argmax breaks ties the same way as the other engines.
+	Takes 5 inputs:
+		n_grp - Needs rows of the material
+		e_grp - Excess rows of the material
+		n_qty, e_qty - Need & excess quantities for all rows
+		shares - ShareBuffer to add the shares to
+	Returns the total quantity shared.
+	'''
+	need = n_qty[n_grp].astype(float)
+	excess = e_qty[e_grp].astype(float)
+	shared = 0.0
+	while True:
+		i = need.argmax()
+		j = excess.argmax()
+		if need[i] <= 0 or excess[j] <= 0:
+			return shared
+
+		share_qty = min(need[i], excess[j])
+		need[i] -= share_qty
+		excess[j] -= share_qty
+		shared += share_qty
+		shares.append(n_grp[i], e_grp[j], share_qty)
+
+def allocate_heap(n_mat, n_qty, e_mat, e_qty, price, progress=None):
+	'''
+	Heap version of the allocation. Keeps a max-heap of needs by need value and
+	a max-heap of excess plants per material, so each share is O(log n) and
+	shares come out in the same order as the original loop.
+	Takes 6 inputs:
+		n_mat, n_qty - Material code & need quantity for each needs row
+		e_mat, e_qty - Material code & excess quantity for each excess row
+		price - Piece price, indexed by material code
+		progress - Optional Progress to report needs searched & revenue to
+	Returns (need row, excess row, share qty) arrays, one entry per share.
+	'''
+	n_mat_list = n_mat.tolist()
+	price_list = price.tolist()
+
+	# Excess plants per material, largest first, ties in original row order
+	excess_heaps = {}
+	for j in np.flatnonzero((e_qty > 0) & (price[e_mat] > 0)).tolist():
+		excess_heaps.setdefault(int(e_mat[j]), []).append((-float(e_qty[j]), j))
+	for heap in excess_heaps.values():
+		heapq.heapify(heap)
+
+	# Needs by value, then quantity, then original row order
+	needs = [
+		(-float(n_qty[i]) * price_list[n_mat_list[i]], -float(n_qty[i]), i)
+		for i in np.flatnonzero((n_qty > 0) & (price[n_mat] > 0)).tolist()
+		]
+	heapq.heapify(needs)
+
+	shares = ShareBuffer(len(needs) + len(excess_heaps))
+	if progress:
+		progress.add(len(n_mat) - len(needs))
+	while needs:
+		_, neg_need, i = heapq.heappop(needs)
+
+		# No excess left for this material, so the need can't be filled
+		heap = excess_heaps.get(n_mat_list[i])
+		if not heap:
+			if progress:
+				progress.add(1)
+			continue
+
+		neg_excess, j = heap[0]
+		need = -neg_need
+		excess = -neg_excess
+		share_qty = min(need, excess)
+		shares.append(i, j, share_qty)
+
+		# Put any leftovers back in their queues
+		if excess > share_qty:
+			heapq.heapreplace(heap, (share_qty - excess, j))
+		else:
+			heapq.heappop(heap)
+		need -= share_qty
+		if need > 0:
+			heapq.heappush(needs, (-need * price_list[n_mat_list[i]], -need, i))
+		if progress:
+			progress.add(int(need <= 0), share_qty * price_list[n_mat_list[i]])
+
+	return shares.arrays()
+
+class ShareBuffer():
+	'''
+	Growable, typed column store for shares. Each column doubles in size when
+	full, so appends are amortised O(1) and the shares dataframe is only built
+	once, at the end of the run.
+	'''
+	dtypes = {"n_row": np.intp, "e_row": np.intp, "qty": float}
+
+	def __init__(self, capacity=1024):
+		self.size = 0
+		self.columns = {key: np.empty(max(capacity, 1), dtype) for key, dtype in self.dtypes.items()}
+
+	def append(self, n_row, e_row, qty):
+		if self.size == len(self.columns["qty"]):
+			self.reserve(self.size + 1)
+		self.columns["n_row"][self.size] = n_row
+		self.columns["e_row"][self.size] = e_row
+		self.columns["qty"][self.size] = qty
+		self.size += 1
+
+	def extend(self, n_rows, e_rows, qty):
+		end = self.size + len(qty)
+		self.reserve(end)
+		self.columns["n_row"][self.size:end] = n_rows
+		self.columns["e_row"][self.size:end] = e_rows
+		self.columns["qty"][self.size:end] = qty
+		self.size = end
+
+	def reserve(self, capacity):
+		if capacity <= len(self.columns["qty"]):
+			return
+		capacity = max(capacity, 2 * len(self.columns["qty"]))
+		for key, col in self.columns.items():
+			grown = np.empty(capacity, col.dtype)
+			grown[:self.size] = col[:self.size]
+			self.columns[key] = grown
+
+	def arrays(self):
+		# Returns (need row, excess row, share qty) arrays trimmed to the shares added
+		return tuple(self.columns[key][:self.size] for key in self.dtypes)
+
+ENGINES = {
+	"vectorized": allocate_codes,
+	"heap": allocate_heap
+	}
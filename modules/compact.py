@@ -0,0 +1,51 @@
+import pandas as pd
+import numpy as np
+
+def frame_bytes(df):
+	'''
+	Measures a dataframe's memory, strings & index included.
+	Takes 1 input:
+		df - Dataframe to measure
+	Returns the size in bytes.
+	'''
+	return int(df.memory_usage(deep=True, index=True).sum())
+
+def compact_frame(df, keep=()):
+	'''
+	Shrinks a dataframe's columns to the smallest dtypes that hold their
+	values exactly. Whole-number quantities become the smallest integer type
+	that fits them, and text columns become categoricals. Quantities with
+	blanks or fractions stay float64, since a narrower float would round them.
+	The plant & material codes are left as they are.
+	Takes 2 inputs:
+		df - Dataframe to shrink
+		keep - Columns to leave untouched
+	Returns the compacted dataframe.
+	'''
+	columns = {}
+	for col in df.columns:
+		values = df[col]
+		if col in keep or col in ("material", "plant"):
+			columns[col] = values
+		elif values.dtype.kind in "iuf":
+			columns[col] = _compact_numbers(values)
+		elif values.dtype.kind == "O":
+			columns[col] = values.astype("category")
+		else:
+			columns[col] = values
+	return pd.DataFrame(columns, index=df.index)
+
+def _compact_numbers(values):
+	# Integers only when every value is whole, so nothing is rounded
+	numbers = values.to_numpy()
+	if numbers.dtype.kind == "f":
+		if not np.isfinite(numbers).all() or not np.array_equal(numbers, np.trunc(numbers)):
+			return values
+	return pd.to_numeric(values, downcast="integer")
+
+def format_bytes(size):
+	# Human readable size for the memory report
+	for unit in ["B", "KB", "MB", "GB"]:
+		if size < 1024 or unit == "GB":
+			return f"{size:,.1f} {unit}"
+		size /= 1024
@@ -0,0 +1,277 @@
+import math
+import pathlib
+import re
+import sqlite3
+import pandas as pd
+import numpy as np
+
+from modules.keys import plant_material_key
+from modules.piece_price import piece_prices
+from modules.schema import ERROR_COLUMNS, STRAY_VALUE_ERROR, TEMPLATE_COLUMNS, match_columns
+
+# File extensions for each database engine
+DB_FORMATS = {
+	'sqlite': ('.sqlite', '.sqlite3', '.db'),
+	'duckdb': ('.duckdb', '.ddb')
+	}
+
+# Quantities stored as text must be wholly a number, as pd.to_numeric requires
+NUMBER_TEXT = re.compile(r'[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?|[+-]?inf(inity)?', re.IGNORECASE)
+INFINITY_TEXT = re.compile(r'[+-]?inf(inity)?', re.IGNORECASE)
+
+# ASCII whitespace str.strip removes, trimmed from text keys & quantities
+WHITESPACE = " \t\n\r\x0b\x0c"
+
+# DuckDB column types read as numbers without parsing
+NUMERIC_TYPES = ("TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT", "UTINYINT", "USMALLINT", "UINTEGER", "UBIGINT", "FLOAT", "DOUBLE", "REAL", "DECIMAL")
+
+def db_format(filename):
+	'''
+	Works out the database engine from the file extension.
+	Takes 1 input:
+		filename - Path of the database file
+	Returns "sqlite" or "duckdb", or None if it isn't a database file.
+	'''
+	name = filename.lower()
+	for fmt, extensions in DB_FORMATS.items():
+		if name.endswith(extensions):
+			return fmt
+	return None
+
+def connect(filename, fmt):
+	# Read-only, so a bad query can never change the staging database
+	if fmt == 'duckdb':
+		import duckdb
+		return duckdb.connect(filename, read_only=True)
+	# The path is percent-encoded, so "#", "?" or "%" in it can't end the URI early
+	con = sqlite3.connect(pathlib.Path(filename).resolve().as_uri() + "?mode=ro", uri=True)
+	con.create_function("invy_number", 1, text_number, deterministic=True)
+	return con
+
+def source_sql(source):
+	# A table name is quoted, anything starting like a query is used as one
+	if source.lstrip().lower().startswith(("select", "with")):
+		return f"({source})"
+	return '"' + source.replace('"', '""') + '"'
+
+def db_columns(filename, source):
+	'''
+	Lists the template columns a database table or query returns, without
+	reading any rows.
+	Takes 2 inputs:
+		filename - Path of the database file
+		source - Table name or SELECT query
+	Returns the template columns found, in template order.
+	'''
+	fmt = db_format(filename)
+	con = connect(filename, fmt)
+	try:
+		cursor = con.execute(f"SELECT * FROM {source_sql(source)} AS src LIMIT 0")
+		names = [col[0] for col in cursor.description]
+	finally:
+		con.close()
+	found = set(match_columns(names).values())
+	return [col for col in TEMPLATE_COLUMNS if col in found]
+
+def db_import(filename, source, batch_rows=100000, status=None):
+	'''
+	Imports the template columns straight from a SQLite or DuckDB table or
+	query. Validation, duplicate merging, the per-material backlog sums for
+	the piece prices and the needs/excess split all run in SQL, and only the
+	split rows come back, fetched in batches.
+	Takes 4 inputs:
+		filename - Path of the database file
+		source - Table name or SELECT query with every template column
+		batch_rows - Rows fetched at a time
+		status - Optional function called with progress messages
+	Returns (needs_df, excess_df, plants, materials, piece prices, rows read,
+	error report), like stream_import. Error rows count records from 1, in
+	the order the database returns them.
+	'''
+	fmt = db_format(filename)
+	con = connect(filename, fmt)
+	try:
+		names = [col[0] for col in con.execute(f"SELECT * FROM {source_sql(source)} AS src LIMIT 0").description]
+		types = _column_types(con, source) if fmt == 'duckdb' else {}
+		ctes = _ctes(fmt, source, {col: name for name, col in match_columns(names).items()}, types)
+
+		# Labels are coded in first-seen order, as encode_keys codes them, and
+		# the backlog totals per material give the piece prices
+		materials = {}
+		qty, val = [], []
+		for material, bklg_qty, bklg_val in con.execute(
+			ctes + "SELECT material, SUM(bklg_qty), SUM(bklg_val) FROM valid GROUP BY material ORDER BY MIN(row_no)"
+			).fetchall():
+			materials[material] = len(materials)
+			qty.append(bklg_qty)
+			val.append(bklg_val)
+		n_materials = len(materials)
+		prices = piece_prices(np.arange(n_materials), np.array(qty, dtype=float), np.array(val, dtype=float), n_materials)
+		plants = {plant: code for code, (plant,) in enumerate(con.execute(
+			ctes + "SELECT plant FROM valid GROUP BY plant ORDER BY MIN(row_no)"
+			).fetchall())}
+
+		rows_read, kept, groups = con.execute(
+			ctes + "SELECT (SELECT COUNT(*) FROM raw), (SELECT COUNT(*) FROM valid), "
+			"(SELECT COUNT(*) FROM (SELECT 1 FROM valid GROUP BY material, plant) AS g)"
+			).fetchone()
+		if status:
+			status(f"Merged {kept - groups:,} duplicate plant/material rows.")
+
+		# Summed need (positive) or excess (negative) per plant & material, in
+		# first-seen order
+		needs, excess = [], []
+		cursor = con.execute(
+			ctes + "SELECT material, plant, SUM(bklg_qty) - SUM(invy) AS qty FROM valid "
+			"GROUP BY material, plant HAVING SUM(bklg_qty) - SUM(invy) <> 0 ORDER BY MIN(row_no)"
+			)
+		fetched = 0
+		while True:
+			batch = cursor.fetchmany(batch_rows)
+			if not batch:
+				break
+			mat, plant, split = zip(*batch)
+			mat = np.fromiter((materials[m] for m in mat), np.int32, len(batch))
+			plant = np.fromiter((plants[p] for p in plant), np.int32, len(batch))
+			split = np.array(split, dtype=float)
+			needs.append((mat[split > 0], plant[split > 0], split[split > 0]))
+			excess.append((mat[split < 0], plant[split < 0], -split[split < 0]))
+			fetched += len(batch)
+			if status:
+				status(f"Fetched {fetched:,} needs & excess rows...")
+
+		errors = pd.DataFrame(con.execute(ctes + _error_sql()).fetchall(), columns=ERROR_COLUMNS)
+	finally:
+		con.close()
+
+	needs_df = _split_frame(needs, "need", n_materials)
+	excess_df = _split_frame(excess, "excess", n_materials)
+	return needs_df, excess_df, pd.Index(list(plants)), pd.Index(list(materials)), prices, rows_read, errors
+
+def _column_types(con, source):
+	# DuckDB columns are typed, which tells whole-number keys stored as floats
+	cursor = con.execute(f"DESCRIBE SELECT * FROM {source_sql(source)} AS src")
+	return {row[0]: str(row[1]).upper() for row in cursor.fetchall()}
+
+def _ctes(fmt, source, columns, types):
+	'''
+	Builds the common table expressions shared by every query: raw numbers
+	each row, typed keeps the raw values and coerces keys to text & quantities
+	to numbers (flagging the ones that aren't), and valid keeps the rows
+	validate would keep, blanking backlog values with no backlog quantity.
+	Takes 4 inputs:
+		fmt - "sqlite" or "duckdb"
+		source - Table name or SELECT query
+		columns - {template column: source column name}
+		types - {source column name: DuckDB type}, empty for SQLite
+	Returns the WITH clause.
+	'''
+	def quoted(col):
+		return '"' + str(columns[col]).replace('"', '""') + '"'
+
+	raw = ", ".join(f"{quoted(col)} AS {col}" for col in TEMPLATE_COLUMNS)
+	typed = ["row_no"]
+	for col in TEMPLATE_COLUMNS:
+		typed.append(f"{col} AS {col}_raw")
+		if col in ("material", "plant"):
+			typed.append(f"{_key_sql(fmt, col, types.get(columns[col], ''))} AS {col}")
+		else:
+			number, bad = _number_sql(fmt, col, types.get(columns[col], ''))
+			typed.append(f"{number} AS {col}")
+			typed.append(f"{bad} AS {col}_bad")
+
+	return (
+		f"WITH raw AS (SELECT ROW_NUMBER() OVER () AS row_no, {raw} FROM {source_sql(source)} AS src), "
+		f"typed AS (SELECT {', '.join(typed)} FROM raw), "
+		"valid AS (SELECT row_no, material, plant, invy, bklg_qty, "
+		"CASE WHEN COALESCE(bklg_qty, 0) = 0 THEN NULL ELSE bklg_val END AS bklg_val FROM typed "
+		"WHERE material IS NOT NULL AND plant IS NOT NULL "
+		"AND NOT invy_bad AND NOT bklg_qty_bad AND NOT bklg_val_bad AND COALESCE(invy, 0) >= 0) "
+		)
+
+def _key_sql(fmt, col, col_type):
+	# Keys as trimmed text, whole numbers stored as floats losing their ".0"
+	if fmt == 'duckdb':
+		if col_type in ("DOUBLE", "FLOAT", "REAL") or col_type.startswith("DECIMAL"):
+			text = f"CASE WHEN {col} = FLOOR({col}) THEN CAST(CAST({col} AS BIGINT) AS VARCHAR) ELSE CAST({col} AS VARCHAR) END"
+		else:
+			text = f"TRIM(CAST({col} AS VARCHAR), '{WHITESPACE}')"
+	else:
+		text = (
+			f"CASE WHEN typeof({col}) = 'real' AND {col} = CAST({col} AS INTEGER) "
+			f"THEN CAST(CAST({col} AS INTEGER) AS TEXT) ELSE TRIM(CAST({col} AS TEXT), '{WHITESPACE}') END"
+			)
+	return f"NULLIF({text}, '')"
+
+def _number_sql(fmt, col, col_type):
+	'''
+	Builds the SQL coercing a quantity column to a number, accepting exactly
+	the text pd.to_numeric accepts, as validate does. SQLite parses leading
+	digits only ("1-2" as 1), so its text values go through text_number.
+	Takes 3 inputs:
+		fmt - "sqlite" or "duckdb"
+		col - Column name
+		col_type - DuckDB type of the source column, empty for SQLite
+	Returns (number or NULL, whether a non-blank value isn't a number).
+	'''
+	if fmt == 'duckdb' and col_type.startswith(NUMERIC_TYPES):
+		blank = f"({col} IS NULL OR isnan(CAST({col} AS DOUBLE)))"
+		number = f"CAST({col} AS DOUBLE)"
+	elif fmt == 'duckdb':
+		text = f"TRIM(CAST({col} AS VARCHAR), '{WHITESPACE}')"
+		blank = f"({col} IS NULL OR {text} = '')"
+		number = (
+			f"CASE WHEN regexp_full_match({text}, '{NUMBER_TEXT.pattern}', 'i') "
+			f"AND (isfinite(TRY_CAST({text} AS DOUBLE)) OR regexp_full_match({text}, '{INFINITY_TEXT.pattern}', 'i')) "
+			f"THEN TRY_CAST({text} AS DOUBLE) END"
+			)
+	else:
+		blank = f"({col} IS NULL OR TRIM(CAST({col} AS TEXT), '{WHITESPACE}') = '')"
+		number = f"CASE WHEN typeof({col}) IN ('integer', 'real') THEN CAST({col} AS REAL) ELSE invy_number({col}) END"
+	return f"CASE WHEN {blank} THEN NULL ELSE {number} END", f"(NOT {blank} AND {number} IS NULL)"
+
+def text_number(value):
+	'''
+	Parses a quantity stored as text the way pd.to_numeric does: surrounding
+	whitespace is ignored, and anything else that isn't wholly a decimal
+	number or infinity is rejected, as are numbers too large for a float.
+	Takes 1 input:
+		value - Value from the database
+	Returns the number as a float, or None if it isn't one.
+	'''
+	if value is None:
+		return None
+	text = str(value).strip()
+	if not NUMBER_TEXT.fullmatch(text):
+		return None
+	number = float(text)
+	if math.isinf(number) and not INFINITY_TEXT.fullmatch(text):
+		return None
+	return number
+
+def _error_sql():
+	# The same checks as validate, one line per problem
+	checks = [
+		("material", "'Missing material'", "material IS NULL"),
+		("plant", "'Missing plant'", "plant IS NULL"),
+		("invy", "'Non-numeric invy'", "invy_bad"),
+		("bklg_qty", "'Non-numeric bklg_qty'", "bklg_qty_bad"),
+		("bklg_val", "'Non-numeric bklg_val'", "bklg_val_bad"),
+		("invy", "'Negative inventory'", "invy < 0"),
+		("bklg_val", f"'{STRAY_VALUE_ERROR}'", "COALESCE(bklg_qty, 0) = 0 AND COALESCE(bklg_val, 0) <> 0")
+		]
+	selects = [
+		f"SELECT row_no, '{col}', {error}, COALESCE(CAST({col}_raw AS VARCHAR), '') FROM typed WHERE {where}"
+		for col, error, where in checks
+		]
+	return "SELECT * FROM (" + " UNION ALL ".join(selects) + ") AS e ORDER BY 1, 2"
+
+def _split_frame(parts, field, n_materials):
+	# Batches of (material, plant, qty) arrays joined into one coded dataframe
+	df = pd.DataFrame({
+		"material": np.concatenate([part[0] for part in parts] or [np.zeros(0, np.int32)]),
+		"plant": np.concatenate([part[1] for part in parts] or [np.zeros(0, np.int32)]),
+		field: np.concatenate([part[2] for part in parts] or [np.zeros(0)])
+		})
+	df.index = plant_material_key(df["plant"], df["material"], n_materials)
+	return df
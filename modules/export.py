@@ -0,0 +1,237 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import os
+import re
+import pandas as pd
+import numpy as np
+
+# File extensions for each export format
+EXPORT_FORMATS = {
+	'xlsx': ('.xlsx',),
+	'parquet': ('.parquet', '.pq'),
+	'csv': ('.csv',),
+	'jsonl': ('.jsonl', '.ndjson')
+	}
+
+# Excel number formats by column, anything else is written as text
+NUMBER_FORMATS = {
+	'Share Qty': '#,##0',
+	'Share Value': '$#,##0.00',
+	'Transfer Cost': '$#,##0.00'
+	}
+
+# Data rows per Excel sheet, leaving the first of its 1,048,576 rows for the header
+SHEET_ROWS = 1048575
+
+# Label columns, dictionary-encoded in parquet
+LABEL_COLUMNS = ['PN', 'Needs Plant', 'Excess Plant']
+
+def export_format(filename):
+	'''
+	Works out the export format from the file extension.
+	Takes 1 input:
+		filename - Path to export to
+	Returns "xlsx", "parquet", "csv" or "jsonl", or None if unsupported.
+	'''
+	name = filename.lower()
+	for fmt, extensions in EXPORT_FORMATS.items():
+		if name.endswith(extensions):
+			return fmt
+	return None
+
+def export_shares(shares, filename, fmt, progress=None, chunk_rows=50000):
+	'''
+	Writes the shares table a chunk of rows at a time, straight from its
+	column arrays.
+	Takes 5 inputs:
+		shares - Shares dataframe
+		filename - Path to write to
+		fmt - "xlsx", "parquet", "csv" or "jsonl", from export_format
+		progress - Optional Progress to report rows written to
+		chunk_rows - Rows written between progress reports
+	'''
+	writers = {'xlsx': write_xlsx, 'parquet': write_parquet, 'csv': write_csv, 'jsonl': write_jsonl}
+	writers[fmt](shares, filename, progress, chunk_rows)
+
+def write_xlsx(shares, filename, progress=None, chunk_rows=50000):
+	'''
+	Streams the shares table into a workbook with xlsxwriter's constant memory
+	mode, which flushes each row to disk once written. Labels are written as
+	text and quantities & values as formatted numbers. Tables longer than an
+	Excel sheet carry on in further sheets, each with its own header.
+	Takes 4 inputs:
+		shares, filename, progress, chunk_rows - Same as export_shares
+	'''
+	import xlsxwriter
+
+	book = xlsxwriter.Workbook(filename, {'constant_memory': True})
+	try:
+		header = book.add_format({'bold': True})
+		formats = {col: book.add_format({'num_format': NUMBER_FORMATS[col]}) for col in shares.columns if col in NUMBER_FORMATS}
+		columns = []
+		for col in shares.columns:
+			if col in formats:
+				columns.append((col, formats[col], shares[col].to_numpy(dtype=float)))
+			else:
+				columns.append((col, None, shares[col].astype(str).to_numpy()))
+
+		# Rows must go out in order, so cells are written row by row
+		rows = len(shares.index)
+		for sheet_start in range(0, max(rows, 1), SHEET_ROWS):
+			sheet = book.add_worksheet()
+			writers = _add_header(sheet, columns, header)
+			sheet_stop = min(sheet_start + SHEET_ROWS, rows)
+			for start in range(sheet_start, sheet_stop, chunk_rows):
+				stop = min(start + chunk_rows, sheet_stop)
+				_write_rows(sheet, writers, start, stop, sheet_start)
+				if progress:
+					progress.add(stop - start)
+	finally:
+		book.close()
+
+def _add_header(sheet, columns, header):
+	# Writes the header row & column formats, returning each column's cell writer
+	writers = []
+	for c, (col, cell_format, values) in enumerate(columns):
+		sheet.write_string(0, c, col, header)
+		sheet.set_column(c, c, 14, cell_format)
+		writers.append((sheet.write_number if cell_format else sheet.write_string, cell_format, values))
+	return writers
+
+def _write_rows(sheet, writers, start, stop, sheet_start=0):
+	# Plain lists index much faster than numpy arrays cell by cell
+	cells = [(c, write, cell_format, values[start:stop].tolist()) for c, (write, cell_format, values) in enumerate(writers)]
+	first = start - sheet_start + 1
+	for r in range(stop - start):
+		for c, write, cell_format, values in cells:
+			value = values[r]
+			if value != value:
+				# Missing numbers are left blank
+				result = sheet.write_blank(first + r, c, None, cell_format)
+			else:
+				result = write(first + r, c, value, cell_format)
+
+			# xlsxwriter returns an error code rather than raising, so a
+			# cell it refuses must not go missing silently
+			if result < 0:
+				raise ValueError(f"Could not write row {start + r + 1:,}, column {c + 1} (xlsxwriter error {result}).")
+
+def shares_table(shares, dictionary=True):
+	'''
+	Converts the shares table to Arrow without copying its numeric columns.
+	Takes 2 inputs:
+		shares - Shares dataframe
+		dictionary - Dictionary-encode the plant & material labels
+	Returns a pyarrow Table.
+	'''
+	import pyarrow as pa
+
+	arrays = {}
+	for col in shares.columns:
+		if col in LABEL_COLUMNS and dictionary:
+			codes, labels = pd.factorize(shares[col].astype(str))
+			arrays[col] = pa.DictionaryArray.from_arrays(pa.array(codes.astype(np.int32)), pa.array(labels.to_numpy(), pa.string()))
+		elif col in LABEL_COLUMNS:
+			arrays[col] = pa.array(shares[col].astype(str).to_numpy(), pa.string())
+		else:
+			arrays[col] = pa.array(shares[col].to_numpy())
+	return pa.table(arrays)
+
+def write_parquet(shares, filename, progress=None, chunk_rows=50000):
+	# Parquet keeps the labels dictionary-encoded, one row group per chunk
+	import pyarrow.parquet as pq
+
+	table = shares_table(shares)
+	with pq.ParquetWriter(filename, table.schema) as writer:
+		for batch in table.to_batches(max_chunksize=chunk_rows):
+			writer.write_batch(batch, row_group_size=chunk_rows)
+			if progress:
+				progress.add(batch.num_rows)
+
+def write_csv(shares, filename, progress=None, chunk_rows=50000):
+	import pyarrow.csv as pa_csv
+
+	# CSV has no dictionaries, so labels are written as plain text
+	table = shares_table(shares, dictionary=False)
+	with pa_csv.CSVWriter(filename, table.schema) as writer:
+		for batch in table.to_batches(max_chunksize=chunk_rows):
+			writer.write_batch(batch)
+			if progress:
+				progress.add(batch.num_rows)
+
+def write_jsonl(shares, filename, progress=None, chunk_rows=50000):
+	# One JSON object per line, converted a chunk at a time
+	with open(filename, 'w', encoding='utf-8') as f:
+		for start in range(0, len(shares.index), chunk_rows):
+			chunk = shares.iloc[start:start + chunk_rows]
+			f.write(chunk.to_json(orient='records', lines=True))
+			if progress:
+				progress.add(len(chunk.index))
+
+def export_lanes(shares, folder, fmt, workers=4, progress=None):
+	'''
+	Writes one file per shipping lane (needs plant & excess plant) into a
+	folder, several at a time on a thread pool, plus a manifest.csv listing
+	each lane's file, share count & totals. The writers spend most of their
+	time in xlsxwriter & Arrow I/O, so threads keep the disk busy.
+	Takes 5 inputs:
+		shares - Shares dataframe
+		folder - Folder to write to (created if missing)
+		fmt - "xlsx", "parquet", "csv" or "jsonl", from export_format
+		workers - Number of files written at once
+		progress - Optional Progress to report rows written to
+	Returns the manifest dataframe.
+	'''
+	os.makedirs(folder, exist_ok=True)
+	lanes = shares.groupby(["Needs Plant", "Excess Plant"], sort=True)
+	totals = [col for col in ["Share Qty", "Share Value", "Transfer Cost"] if col in shares.columns]
+	manifest = lanes[totals].sum().reset_index()
+	manifest.insert(2, "Shares", lanes.size().to_numpy())
+	manifest.insert(0, "File", pd.Series(
+		_lane_filenames(manifest["Needs Plant"], manifest["Excess Plant"], fmt), index=manifest.index, dtype=object
+		))
+
+	# A run with no shares has no lanes, just an empty manifest
+	if manifest.empty:
+		manifest.to_csv(os.path.join(folder, "manifest.csv"), index=False)
+		return manifest
+
+	# Two lanes sharing a file would be written by two threads at once
+	names = [name.lower() for name in manifest["File"]]
+	if len(set(names)) != len(names):
+		raise ValueError("Lane file names must be unique.")
+
+	# Progress is only touched from this thread, as each lane finishes
+	rows = lanes.indices
+	with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+		futures = {
+			pool.submit(export_shares, shares.iloc[rows[lane]], os.path.join(folder, name), fmt): len(rows[lane])
+			for lane, name in zip(zip(manifest["Needs Plant"], manifest["Excess Plant"]), manifest["File"])
+			}
+		for future in as_completed(futures):
+			future.result()
+			if progress:
+				progress.add(futures[future])
+
+	manifest.to_csv(os.path.join(folder, "manifest.csv"), index=False)
+	return manifest
+
+def _lane_filenames(needs, excess, fmt):
+	'''
+	Names each lane's file after its plants, made safe to use in a file name.
+	Different labels can clean up to the same name ("A B", "A/B" & "A_B", or
+	labels containing "_to_"), so clashing names get a short hash of the raw
+	labels. Names are compared ignoring case, for case-insensitive disks.
+	Takes 3 inputs:
+		needs, excess - Needs & excess plant label of each lane
+		fmt - Export format, for the file extension
+	Returns a list of file names, one per lane.
+	'''
+	lanes = list(zip(needs, excess))
+	names = [re.sub(r'[^\w.-]', '_', f"{need}_to_{excess}") for need, excess in lanes]
+	counts = pd.Series(names).str.lower().value_counts()
+	extension = EXPORT_FORMATS[fmt][0]
+	return [
+		name + ("_" + hashlib.blake2b(repr(lane).encode(), digest_size=4).hexdigest() if counts[name.lower()] > 1 else "") + extension
+		for name, lane in zip(names, lanes)
+		]
@@ -0,0 +1,75 @@
+import io
+import json
+import os
+import pandas as pd
+
+# Formats slow enough to parse that caching them pays off
+CACHED_FORMATS = ('excel', 'csv')
+
+# Bumped whenever validation changes what a cached import holds
+CACHE_VERSION = 2
+
+def cache_path(filename):
+	'''
+	Where the import cache of a file lives: a hidden Arrow file next to it.
+	Takes 1 input:
+		filename - Path of the source file
+	Returns the cache file path.
+	'''
+	folder, name = os.path.split(os.path.abspath(filename))
+	return os.path.join(folder, "." + name + ".invy.arrow")
+
+def source_key(filename):
+	# Any change to the file's path, size or modified time, or to how imports
+	# are validated, invalidates its cache
+	stat = os.stat(filename)
+	return json.dumps([os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, CACHE_VERSION])
+
+def read_import_cache(filename):
+	'''
+	Memory-maps the import cache of a file, if one was written for this exact
+	version of it.
+	Takes 1 input:
+		filename - Path of the source file
+	Returns (dataframe, error report, fingerprint), or None if there is no
+	valid cache.
+	'''
+	try:
+		import pyarrow as pa
+		with pa.memory_map(cache_path(filename)) as source:
+			table = pa.ipc.open_file(source).read_all()
+		meta = table.schema.metadata or {}
+		if meta.get(b"invy_source", b"").decode() != source_key(filename):
+			return None
+		errors = pd.read_json(io.StringIO(meta[b"invy_errors"].decode()), orient="table")
+		return table.to_pandas(), errors, meta[b"invy_fingerprint"].decode()
+	except (OSError, ImportError, KeyError, ValueError):
+		return None
+
+def write_import_cache(filename, df, errors, fingerprint):
+	'''
+	Writes a parsed & validated import next to its source file as an
+	uncompressed Arrow IPC file, so later imports can memory-map it. The
+	validation report rides along in the file's metadata.
+	Takes 4 inputs:
+		filename - Path of the source file
+		df - Validated dataframe with the template columns
+		errors - Error report from validate
+		fingerprint - Contents fingerprint of the source file
+	'''
+	import pyarrow as pa
+
+	table = pa.Table.from_pandas(df, preserve_index=False)
+	table = table.replace_schema_metadata({
+		"invy_source": source_key(filename),
+		"invy_fingerprint": fingerprint,
+		"invy_errors": errors.to_json(orient="table", index=False)
+		})
+
+	# Writes to a temporary file first, so a failed write never leaves a
+	# partial cache behind
+	path = cache_path(filename)
+	with pa.OSFile(path + ".tmp", "wb") as sink:
+		with pa.ipc.new_file(sink, table.schema) as writer:
+			writer.write_table(table)
+	os.replace(path + ".tmp", path)
@@ -1,16 +1,266 @@
-from PyQt5 import QtWidgets as qtw
-from PyQt5 import QtGui as qtg
-from PyQt5 import QtCore as qtc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+import importlib.util
+import time
 import pandas as pd
-import numpy as np
+
+from modules.import_cache import CACHED_FORMATS, read_import_cache, write_import_cache
+from modules.result_cache import file_fingerprint
+from modules.schema import TEMPLATE_COLUMNS, TEMPLATE_DTYPES, match_columns, validate
+
+# File extensions for each input format, compressed CSVs included
+FORMATS = {
+	'excel': ('.xls', '.xlsx'),
+	'csv': ('.csv', '.csv.gz', '.csv.zst', '.csv.bz2'),
+	'parquet': ('.parquet', '.pq'),
+	'feather': ('.feather', '.arrow', '.ipc')
+	}
+
+def file_format(filename):
+	'''
+	Works out the input format from the file extension.
+	Takes 1 input:
+		filename - Path of the input file
+	Returns "excel", "csv", "parquet" or "feather", or None if unsupported.
+	'''
+	name = filename.lower()
+	for fmt, extensions in FORMATS.items():
+		if name.endswith(extensions):
+			return fmt
+	return None
+
+def excel_engine():
+	'''
+	Picks the fastest installed xlsx reader. python-calamine parses several
+	times faster than openpyxl; without it pandas picks its default reader.
+	Returns the engine name to pass to pd.read_excel, or None for the default.
+	'''
+	if importlib.util.find_spec("python_calamine") is not None:
+		return "calamine"
+	return None
 
 def import_file(filename):
+	'''
+	Reads only the template columns of an input file. Other columns are
+	skipped by the reader instead of being parsed and dropped, and missing
+	template columns are left for the caller to report. Column names are
+	matched to the template ignoring case, and renamed to it.
+	Takes 1 input:
+		filename - Path of an excel, csv, parquet or feather file
+	Returns (dataframe, seconds taken to read it). Values are left as read,
+	for validate to coerce.
+	'''
+	start = time.perf_counter()
+	fmt = file_format(filename)
+	if fmt == 'excel':
+		df = pd.read_excel(
+			filename,
+			usecols=lambda col: str(col).strip().lower() in TEMPLATE_COLUMNS,
+			dtype=object,
+			engine=excel_engine()
+			)
+		matched = match_columns(df.columns)
+		df = df[list(matched)].rename(columns=matched)
+	elif fmt is not None:
+		df = read_arrow(filename, fmt).to_pandas()
+	else:
+		raise ValueError(f"Unsupported file type: {filename}")
+	return df, time.perf_counter() - start
+
+def load_file(filename, use_cache=False):
+	'''
+	Reads & validates a file, going through its import cache when asked, and
+	fingerprints its contents.
+	Takes 2 inputs:
+		filename - Path of an excel, csv, parquet or feather file
+		use_cache - Read & write the import cache next to excel & csv files
+	Returns (dataframe, error report, fingerprint, seconds taken, whether the
+	cache was used). If template columns are missing, the dataframe is
+	returned as read, with no error report.
+	'''
+	start = time.perf_counter()
+	use_cache = use_cache and file_format(filename) in CACHED_FORMATS
+	cached = read_import_cache(filename) if use_cache else None
+	if cached is not None:
+		df, errors, fingerprint = cached
+		return df, errors, fingerprint, time.perf_counter() - start, True
+
+	df, _ = import_file(filename)
+	fingerprint = file_fingerprint(filename)
+	if set(df.columns) != set(TEMPLATE_COLUMNS):
+		return df, None, fingerprint, time.perf_counter() - start, False
+
+	df, errors = validate(df[TEMPLATE_COLUMNS])
+	if use_cache:
+		try:
+			write_import_cache(filename, df, errors, fingerprint)
+		except OSError:
+			# A read-only folder just means the file is parsed every time
+			pass
+	return df, errors, fingerprint, time.perf_counter() - start, False
+
+def load_files(filenames, workers=1, use_cache=False):
+	'''
+	Reads several files at once with load_file. Excel parsing holds the GIL,
+	so excel files are read in worker processes; the Arrow readers release
+	it and run on threads.
+	Takes 3 inputs:
+		filenames - Paths of the files to read
+		workers - Number of files to read at once (1 reads them in turn)
+		use_cache - Same as load_file
+	Returns a list of load_file results, in filename order.
+	'''
+	workers = min(workers, len(filenames))
+	if workers <= 1:
+		return [load_file(filename, use_cache) for filename in filenames]
+
+	excel = any(file_format(filename) == 'excel' for filename in filenames)
+	pool_type = ProcessPoolExecutor if excel else ThreadPoolExecutor
+	with pool_type(max_workers=workers) as pool:
+		return list(pool.map(load_file, filenames, repeat(use_cache)))
+
+def template_columns(filename):
+	'''
+	Lists the template columns in a file from its header alone, without
+	reading any rows.
+	Takes 1 input:
+		filename - Path of an excel, csv, parquet or feather file
+	Returns the template columns found, in template order.
+	'''
+	found = set(match_columns(_header(filename)).values())
+	return [col for col in TEMPLATE_COLUMNS if col in found]
+
+def _header(filename):
+	fmt = file_format(filename)
+	if fmt == 'excel':
+		return pd.read_excel(filename, nrows=0, engine=excel_engine()).columns
+	if fmt == 'csv':
+		import pyarrow.csv as pa_csv
+		with pa_csv.open_csv(filename) as reader:
+			return reader.schema.names
+	if fmt is not None:
+		import pyarrow.dataset as ds
+		return ds.dataset(filename, format=_dataset_format(fmt)).schema.names
+	raise ValueError(f"Unsupported file type: {filename}")
+
+def read_chunks(filename, chunk_rows):
+	'''
+	Reads the template columns of a file a chunk at a time, so files larger
+	than memory can be imported. All template columns must be present.
+	Takes 2 inputs:
+		filename - Path of an excel, csv, parquet or feather file
+		chunk_rows - Rough number of rows per chunk
+	Yields dataframes with the template columns, for validate to coerce.
+	'''
+	fmt = file_format(filename)
+	if fmt == 'excel':
+		yield from _excel_chunks(filename, chunk_rows)
+		return
+
+	import pyarrow.csv as pa_csv
+	import pyarrow.dataset as ds
+	import pyarrow.parquet as pq
+
+	matched = match_columns(_header(filename))
+	if fmt == 'csv':
+		# Block size is in bytes, so allow ~64 bytes a row. Quantities are read
+		# as text, so a bad value is reported instead of failing the read
+		batches = pa_csv.open_csv(
+			filename,
+			read_options=pa_csv.ReadOptions(use_threads=True, block_size=max(chunk_rows * 64, 2**20)),
+			convert_options=_csv_options(matched, numbers=False)
+			)
+	elif fmt == 'parquet':
+		batches = pq.ParquetFile(filename).iter_batches(batch_size=chunk_rows, columns=list(matched))
+	else:
+		batches = ds.dataset(filename, format='ipc').to_batches(columns=list(matched), batch_size=chunk_rows)
+
+	for batch in batches:
+		yield _cast_template(batch, matched).to_pandas()
+
+def _excel_chunks(filename, chunk_rows):
+	# Old .xls files are capped at 65,536 rows, so they are read whole
+	if filename.lower().endswith('.xls'):
+		df, _ = import_file(filename)
+		for start in range(0, len(df), chunk_rows):
+			yield df[TEMPLATE_COLUMNS].iloc[start:start + chunk_rows].reset_index(drop=True)
+		return
+
+	from openpyxl import load_workbook
+	book = load_workbook(filename, read_only=True, data_only=True)
 	try:
-		raw_df = pd.read_excel(filename)
-		return raw_df
-	except PermissionError:
-		print("ERROR: Please close program before running script.")
-		return 1
-	except Exception as error:
-		print(f"An upexpected error has occured: {error}")
-		return 2
\ No newline at end of file
+		rows = book.worksheets[0].iter_rows(values_only=True)
+		header = list(next(rows, ()))
+		matched = {col: header.index(name) for name, col in match_columns(header).items()}
+		positions = [matched[col] for col in TEMPLATE_COLUMNS]
+		chunk = []
+		for row in rows:
+			chunk.append([row[i] if i < len(row) else None for i in positions])
+			if len(chunk) >= chunk_rows:
+				yield pd.DataFrame(chunk, columns=TEMPLATE_COLUMNS)
+				chunk = []
+		if chunk:
+			yield pd.DataFrame(chunk, columns=TEMPLATE_COLUMNS)
+	finally:
+		book.close()
+
+def read_arrow(filename, fmt):
+	'''
+	Reads the template columns of a csv, parquet or feather file with the
+	multithreaded Arrow readers. Keys are cast to text and numeric columns to
+	float64; text quantities are left for validate to coerce.
+	Takes 2 inputs:
+		filename - Path of the input file (.gz/.zst/.bz2 csvs are decompressed)
+		fmt - "csv", "parquet" or "feather", from file_format
+	Returns a pyarrow Table holding the template columns found in the file.
+	'''
+	import pyarrow as pa
+	import pyarrow.csv as pa_csv
+	import pyarrow.dataset as ds
+
+	matched = match_columns(_header(filename))
+	if fmt == 'csv':
+		try:
+			table = pa_csv.read_csv(
+				filename,
+				read_options=pa_csv.ReadOptions(use_threads=True),
+				convert_options=_csv_options(matched, numbers=True)
+				)
+		except pa.ArrowInvalid:
+			# A quantity that isn't a number: read them as text to find which
+			table = pa_csv.read_csv(
+				filename,
+				read_options=pa_csv.ReadOptions(use_threads=True),
+				convert_options=_csv_options(matched, numbers=False)
+				)
+	else:
+		table = ds.dataset(filename, format=_dataset_format(fmt)).to_table(columns=list(matched), use_threads=True)
+	return _cast_template(table, matched)
+
+def _dataset_format(fmt):
+	return 'parquet' if fmt == 'parquet' else 'ipc'
+
+def _csv_options(matched, numbers):
+	import pyarrow as pa
+	import pyarrow.csv as pa_csv
+	return pa_csv.ConvertOptions(
+		include_columns=list(matched),
+		column_types={
+			name: pa.float64() if numbers and TEMPLATE_DTYPES[col] is not str else pa.string()
+			for name, col in matched.items()
+			},
+		strings_can_be_null=True
+		)
+
+def _cast_template(table, matched):
+	# Works on Tables & RecordBatches alike, renaming columns to the template
+	import pyarrow as pa
+	columns = {}
+	for name, col in matched.items():
+		values = table.column(name)
+		if TEMPLATE_DTYPES[col] is str:
+			values = values.cast(pa.string())
+		elif pa.types.is_integer(values.type) or pa.types.is_floating(values.type):
+			values = values.cast(pa.float64())
+		columns[col] = values
+	return pa.table(columns)
@@ -0,0 +1,68 @@
+import pandas as pd
+import numpy as np
+
+from modules.piece_price import piece_prices
+
+VALUE_COLUMNS = ["invy", "bklg_qty", "bklg_val"]
+
+def changed_materials(old_df, old_plants, old_materials, new_df, new_plants, new_materials):
+	'''
+	Diffs two imports by (plant, material), mapping the old codes onto the new
+	ones so the join runs on integers.
+	Takes 6 inputs:
+		old_df, new_df - Coded raw dataframes from the two imports
+		old_plants, new_plants - Plant labels, indexed by code
+		old_materials, new_materials - Material labels, indexed by code
+	Returns an Index of the material labels with an added, removed or changed row.
+	'''
+	plant_map = new_plants.get_indexer(old_plants)
+	mat_map = new_materials.get_indexer(old_materials)
+	old = old_df[VALUE_COLUMNS].assign(
+		plant=plant_map[old_df["plant"].to_numpy()],
+		material=mat_map[old_df["material"].to_numpy()]
+		)
+	new = new_df[["plant", "material"] + VALUE_COLUMNS]
+
+	merged = old.merge(new, on=["plant", "material"], how="outer", suffixes=("_old", "_new"), indicator=True)
+	changed = (merged["_merge"] != "both").to_numpy()
+	for col in VALUE_COLUMNS:
+		old_val = merged[col + "_old"]
+		new_val = merged[col + "_new"]
+		changed |= ~((old_val == new_val) | (old_val.isna() & new_val.isna())).to_numpy()
+
+	# Materials that are gone from the new import have no new code
+	codes = merged.loc[changed, "material"].to_numpy()
+	removed = old_materials[np.unique(old_df["material"].to_numpy()[mat_map[old_df["material"].to_numpy()] < 0])]
+	return new_materials[np.unique(codes[codes >= 0])].append(removed)
+
+def splice_piece_prices(old_prices, old_materials, new_df, new_materials, changed):
+	'''
+	Carries piece prices over from the last run, recalculating only the
+	materials that changed.
+	Takes 5 inputs:
+		old_prices - Piece prices from the last run, indexed by old material code
+		old_materials - Material labels of the last run
+		new_df - Coded raw dataframe of the new import
+		new_materials - Material labels of the new import
+		changed - Material labels from changed_materials
+	Returns an array of piece prices, indexed by new material code.
+	'''
+	price = pd.Series(old_prices, index=old_materials).reindex(new_materials).to_numpy(dtype=float)
+
+	dirty = new_materials.isin(changed)
+	rows = new_df[dirty[new_df["material"].to_numpy()]]
+	price[dirty] = piece_prices(rows["material"].to_numpy(), rows["bklg_qty"], rows["bklg_val"], len(new_materials))[dirty]
+	return price
+
+def splice_shares(old_shares, new_shares, changed):
+	'''
+	Replaces the shares of changed materials with freshly allocated ones.
+	Takes 3 inputs:
+		old_shares - Shares dataframe from the last run
+		new_shares - Shares dataframe for the changed materials only
+		changed - Material labels from changed_materials
+	Returns the combined shares dataframe, sorted by share value descending.
+	'''
+	kept = old_shares[~old_shares["PN"].isin(changed)]
+	shares = pd.concat([kept, new_shares], ignore_index=True)
+	return shares.sort_values("Share Value", ascending=False, kind="stable", ignore_index=True)
@@ -0,0 +1,49 @@
+import pandas as pd
+import numpy as np
+
+def encode_keys(df):
+	'''
+	Replaces the plant & material labels with compact integer codes, so
+	lookups and joins hash integers instead of building "plant_material"
+	strings. Rows missing a plant or material can't be matched and are dropped.
+	Takes 1 input:
+		df - Dataframe with "plant" & "material" columns
+	Returns (df, plants, materials): the coded dataframe indexed by the integer
+	"plant_material" key, plus the code -> label lookups for plants & materials.
+	'''
+	mat_codes, materials = pd.factorize(df["material"])
+	plant_codes, plants = pd.factorize(df["plant"])
+	found = (mat_codes >= 0) & (plant_codes >= 0)
+
+	df = df[found].assign(material=mat_codes[found].astype(np.int32), plant=plant_codes[found].astype(np.int32))
+	df.index = plant_material_key(df["plant"], df["material"], len(materials))
+	return df, plants, materials
+
+def plant_material_key(plant, material, n_materials):
+	'''
+	Combines plant & material codes into a single integer key.
+	Takes 3 inputs:
+		plant - Plant codes
+		material - Material codes
+		n_materials - Number of material codes
+	Returns an index of "plant_material" keys.
+	'''
+	key = np.asarray(plant, dtype=np.int64) * n_materials + np.asarray(material, dtype=np.int64)
+	return pd.Index(key, name="plant_material")
+
+def sum_duplicates(df, n_materials):
+	'''
+	Merges rows sharing a plant & material in one grouped pass over the
+	"plant_material" key, summing their quantities & values. A value stays
+	missing only if it is missing on every merged row. Groups keep the
+	position of their first row.
+	Takes 2 inputs:
+		df - Coded dataframe from encode_keys
+		n_materials - Number of material codes
+	Returns (df, number of rows merged away).
+	'''
+	summed = df[["invy", "bklg_qty", "bklg_val"]].groupby(level=0, sort=False).sum(min_count=1)
+	key = summed.index.to_numpy()
+	summed.insert(0, "plant", (key // n_materials).astype(np.int32))
+	summed.insert(0, "material", (key % n_materials).astype(np.int32))
+	return summed, len(df.index) - len(summed.index)
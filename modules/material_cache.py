@@ -0,0 +1,197 @@
+import hashlib
+import os
+import sqlite3
+import time
+import pandas as pd
+import numpy as np
+
+from modules.allocation import ENGINE_VERSION, allocate_rows, build_shares
+
+class MaterialCache():
+	'''
+	Persistent cache of per-material allocations, stored in a SQLite file.
+	Entries are keyed by a hash of the material's input rows and evicted least
+	recently used first once the cache grows past max_bytes. A locked or
+	unreadable file never fails a run: lookups miss, stores are skipped and
+	the problem is kept in error.
+	Takes 2 inputs:
+		filename - SQLite file to keep the cache in (created if missing)
+		max_bytes - Size limit for the cached shares
+	'''
+
+	def __init__(self, filename, max_bytes=256 * 2**20):
+		os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+		self.max_bytes = max_bytes
+		self.error = None
+		self.db = sqlite3.connect(filename)
+		self.db.execute(
+			"CREATE TABLE IF NOT EXISTS shares (key BLOB PRIMARY KEY, data BLOB, size INTEGER, used REAL)"
+			)
+		self.db.execute("CREATE INDEX IF NOT EXISTS shares_used ON shares (used)")
+
+	def get_many(self, keys):
+		# Returns {key: data} for the keys found, marking them as just used
+		try:
+			return self._get_many(keys)
+		except (sqlite3.Error, OSError) as error:
+			self.error = error
+			return {}
+
+	def _get_many(self, keys):
+		found = {}
+		now = time.time()
+		for k in range(0, len(keys), 500):
+			chunk = keys[k:k + 500]
+			marks = ",".join("?" * len(chunk))
+			found.update(self.db.execute(f"SELECT key, data FROM shares WHERE key IN ({marks})", chunk))
+			self.db.execute(f"UPDATE shares SET used = ? WHERE key IN ({marks})", [now] + chunk)
+		self.db.commit()
+		return found
+
+	def put_many(self, entries):
+		# Stores {key: data}, then evicts the oldest entries beyond max_bytes
+		try:
+			self._put_many(entries)
+		except (sqlite3.Error, OSError) as error:
+			self.error = error
+			self.db.rollback()
+
+	def _put_many(self, entries):
+		now = time.time()
+		self.db.executemany(
+			"INSERT OR REPLACE INTO shares VALUES (?, ?, ?, ?)",
+			((key, data, len(data), now) for key, data in entries.items())
+			)
+		total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM shares").fetchone()[0]
+		if total > self.max_bytes:
+			stale = []
+			for key, size in self.db.execute("SELECT key, size FROM shares ORDER BY used"):
+				if total <= self.max_bytes:
+					break
+				stale.append((key,))
+				total -= size
+			self.db.executemany("DELETE FROM shares WHERE key = ?", stale)
+		self.db.commit()
+
+	def clear(self):
+		self.db.execute("DELETE FROM shares")
+		self.db.commit()
+		self.db.execute("VACUUM")
+
+	def close(self):
+		self.db.close()
+
+def allocate_cached(cache, needs_df, excess_df, price, plants, materials, engine="vectorized", workers=1, progress=None):
+	'''
+	Allocates like allocate, but looks each material up in a MaterialCache
+	first and only runs the engine for materials it hasn't seen. A material's
+	shares depend only on its own rows & piece price, so those (plus the
+	engine version) make up the cache key. The greedy engines return the same
+	shares, so they share entries.
+	Takes 9 inputs:
+		cache - MaterialCache to read & fill
+		needs_df, excess_df, price, plants, materials, engine, workers, progress -
+			Same as allocate
+	Returns the shares dataframe, sorted by share value descending.
+	'''
+	n_mat = needs_df["material"].to_numpy()
+	e_mat = excess_df["material"].to_numpy()
+	price = np.asarray(price, dtype=float)
+
+	# Rows of each material in dataframe order, which is the tie-break order
+	n_order, n_start = _group(n_mat, len(price))
+	e_order, e_start = _group(e_mat, len(price))
+	mats = np.flatnonzero((np.diff(n_start) > 0) & (np.diff(e_start) > 0))
+	keys = _material_keys(needs_df, excess_df, price, plants, n_order, n_start, e_order, e_start, mats)
+
+	hits = cache.get_many(keys)
+	hit = np.zeros(len(price), dtype=bool)
+	hit[mats[[key in hits for key in keys]]] = True
+
+	# Allocate the materials the cache doesn't know
+	n_miss = np.flatnonzero(~hit[n_mat])
+	e_miss = np.flatnonzero(~hit[e_mat])
+	i, j, qty = allocate_rows(needs_df.iloc[n_miss], excess_df.iloc[e_miss], price, engine, workers, progress)
+	parts = [(n_miss[i], e_miss[j], qty)]
+
+	# Store the new results by position within their material
+	n_local = np.empty(len(n_mat), dtype=np.int64)
+	n_local[n_order] = np.arange(len(n_mat)) - np.repeat(n_start[:-1], np.diff(n_start))
+	e_local = np.empty(len(e_mat), dtype=np.int64)
+	e_local[e_order] = np.arange(len(e_mat)) - np.repeat(e_start[:-1], np.diff(e_start))
+	new_rows = n_miss[i]
+	new_excess = e_miss[j]
+	order = np.argsort(n_mat[new_rows], kind="stable")
+	share_mat = n_mat[new_rows][order]
+
+	# Every material's shares are found in one search, in the codes' own dtype
+	bounds = np.searchsorted(share_mat, np.r_[mats, mats + 1].astype(share_mat.dtype))
+	entries = {}
+	for key, m, lo, hi in zip(keys, mats.tolist(), bounds[:len(mats)].tolist(), bounds[len(mats):].tolist()):
+		if hit[m]:
+			continue
+		sel = order[lo:hi]
+		entries[key] = _pack(n_local[new_rows[sel]], e_local[new_excess[sel]], qty[sel])
+	cache.put_many(entries)
+
+	# Map cached results back onto this run's rows
+	for key, m in zip(keys, mats.tolist()):
+		if not hit[m]:
+			continue
+		local_i, local_j, cached_qty = _unpack(hits[key])
+		rows = n_order[n_start[m]:n_start[m + 1]]
+		parts.append((rows[local_i], e_order[e_start[m]:e_start[m + 1]][local_j], cached_qty))
+		if progress:
+			progress.add(len(rows), cached_qty.sum() * price[m])
+
+	n_row, e_row, qty = (np.concatenate(col) for col in zip(*parts))
+	return build_shares(needs_df, excess_df, price, plants, materials, n_row, e_row, qty)
+
+def _group(mat, n_materials):
+	# Stable order of rows by material, plus where each material's rows start
+	order = np.argsort(mat, kind="stable")
+	start = np.concatenate(([0], np.cumsum(np.bincount(mat, minlength=n_materials))))
+	return order, start
+
+def _material_keys(needs_df, excess_df, price, plants, n_order, n_start, e_order, e_start, mats):
+	'''
+	Hashes each material's rows (plant, quantity, in order), piece price and the
+	engine version. Plants are hashed by label, since codes change per import.
+	Takes 9 inputs:
+		needs_df, excess_df - Dataframes with "plant", "need" & "excess"
+		price - Piece price, indexed by material code
+		plants - Plant labels, indexed by plant code
+		n_order, n_start, e_order, e_start - Row grouping from _group
+		mats - Material codes to hash
+	Returns a list of keys, one per material in mats.
+	'''
+	plant_hash = pd.util.hash_pandas_object(pd.Series(np.asarray(plants).astype(str)), index=False).to_numpy()
+	record = np.dtype([("plant", "<u8"), ("qty", "<f8")])
+
+	n_rec = np.empty(len(n_order), dtype=record)
+	n_rec["plant"] = plant_hash[needs_df["plant"].to_numpy()[n_order]]
+	n_rec["qty"] = needs_df["need"].to_numpy(dtype=float)[n_order]
+	e_rec = np.empty(len(e_order), dtype=record)
+	e_rec["plant"] = plant_hash[excess_df["plant"].to_numpy()[e_order]]
+	e_rec["qty"] = excess_df["excess"].to_numpy(dtype=float)[e_order]
+
+	version = str(ENGINE_VERSION).encode()
+	keys = []
+	for m in mats.tolist():
+		h = hashlib.blake2b(version, digest_size=16)
+		h.update(np.float64(price[m]).tobytes())
+		h.update(n_rec[n_start[m]:n_start[m + 1]].tobytes())
+		h.update(b"|")
+		h.update(e_rec[e_start[m]:e_start[m + 1]].tobytes())
+		keys.append(h.digest())
+	return keys
+
+def _pack(i, j, qty):
+	return i.astype("<i4").tobytes() + j.astype("<i4").tobytes() + qty.astype("<f8").tobytes()
+
+def _unpack(data):
+	count = len(data) // 16
+	i = np.frombuffer(data, "<i4", count)
+	j = np.frombuffer(data, "<i4", count, 4 * count)
+	qty = np.frombuffer(data, "<f8", count, 8 * count)
+	return i, j, qty
@@ -0,0 +1,196 @@
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import numpy as np
+
+from modules.allocation import allocate_codes, build_shares, ShareBuffer
+
+LANE_COLUMNS = ["need_plant", "excess_plant", "unit_cost"]
+
+def load_lane_costs(filename, plants):
+	'''
+	Reads a lane cost file into a matrix of per-piece transfer costs. Lanes
+	missing from the file cost nothing, the same as in the greedy engines.
+	Takes 2 inputs:
+		filename - .csv, .xls or .xlsx file with need_plant, excess_plant & unit_cost columns
+		plants - Plant labels, indexed by plant code
+	Returns the cost matrix, indexed by [need plant code, excess plant code].
+	'''
+	if filename.lower().endswith(".csv"):
+		lanes = pd.read_csv(filename)
+	else:
+		lanes = pd.read_excel(filename)
+
+	if not set(LANE_COLUMNS).issubset(lanes.columns):
+		raise ValueError("Lane cost file must have the columns: " + ", ".join(LANE_COLUMNS))
+
+	# Match plants by label text, so 1001 and "1001" are the same plant
+	labels = pd.Index(np.asarray(plants).astype(str))
+	need = labels.get_indexer(lanes["need_plant"].astype(str))
+	excess = labels.get_indexer(lanes["excess_plant"].astype(str))
+	known = (need >= 0) & (excess >= 0)
+
+	cost = np.zeros((len(labels), len(labels)))
+	cost[need[known], excess[known]] = lanes["unit_cost"].to_numpy(dtype=float)[known]
+	return cost
+
+def allocate_optimal(needs_df, excess_df, price, plants, materials, cost, workers=1, progress=None):
+	'''
+	Allocates excess to maximise revenue minus transfer cost, solving each
+	material as a transportation problem. Materials whose lanes are all free
+	keep the greedy allocation, which is already optimal for them. Materials
+	with a single need or excess plant are filled best margin first, and the
+	rest are solved as linear programs, spread over worker processes.
+	Takes 8 inputs:
+		needs_df - Dataframe with "material", "plant" & "need"
+		excess_df - Dataframe with "material", "plant" & "excess"
+		price - Piece price, indexed by material code
+		plants, materials - Plant & material labels, indexed by code
+		cost - Transfer cost matrix from load_lane_costs
+		workers - Number of worker processes (1 runs in this process)
+		progress - Optional Progress to report needs searched & revenue to
+	Returns the shares dataframe, with a "Transfer Cost" column.
+	'''
+	n_mat = needs_df["material"].to_numpy()
+	n_plant = needs_df["plant"].to_numpy()
+	n_qty = needs_df["need"].to_numpy(dtype=float)
+	e_mat = excess_df["material"].to_numpy()
+	e_plant = excess_df["plant"].to_numpy()
+	e_qty = excess_df["excess"].to_numpy(dtype=float)
+	price = np.asarray(price, dtype=float)
+	n_materials = len(price)
+
+	# Rows that can take part in a share, grouped by material
+	n_rows, n_cnt = _group_rows(n_mat, n_qty, price, n_materials)
+	e_rows, e_cnt = _group_rows(e_mat, e_qty, price, n_materials)
+	active = (n_cnt > 0) & (e_cnt > 0)
+	n_rows = n_rows[active[n_mat[n_rows]]]
+	e_rows = e_rows[active[e_mat[e_rows]]]
+	n_cnt = np.where(active, n_cnt, 0)
+	e_cnt = np.where(active, e_cnt, 0)
+	if progress:
+		progress.add(len(n_mat) - len(n_rows))
+
+	# Cost of every need/excess lane within each material
+	pair_n, pair_e = _material_pairs(n_rows, e_rows, n_mat, n_cnt, e_cnt)
+	pair_cost = cost[n_plant[pair_n], e_plant[pair_e]]
+	costly = np.bincount(n_mat[pair_n], weights=(pair_cost != 0), minlength=n_materials) > 0
+
+	# Free lanes only: the greedy engine is optimal
+	shares = ShareBuffer(len(n_rows) + len(e_rows))
+	n_free = n_rows[~costly[n_mat[n_rows]]]
+	e_free = e_rows[~costly[e_mat[e_rows]]]
+	i, j, qty = allocate_codes(n_mat[n_free], n_qty[n_free], e_mat[e_free], e_qty[e_free], price, progress)
+	shares.extend(n_free[i], e_free[j], qty)
+
+	# Everything else is a transportation problem over the material's lanes
+	n_start = np.concatenate(([0], np.cumsum(n_cnt)))
+	e_start = np.concatenate(([0], np.cumsum(e_cnt)))
+	p_start = np.concatenate(([0], np.cumsum(n_cnt * e_cnt)))
+	groups, problems = [], []
+	for m in np.flatnonzero(costly).tolist():
+		n_grp = n_rows[n_start[m]:n_start[m + 1]]
+		e_grp = e_rows[e_start[m]:e_start[m + 1]]
+		margin = price[m] - pair_cost[p_start[m]:p_start[m + 1]].reshape(len(n_grp), len(e_grp))
+		groups.append((n_grp, e_grp, price[m]))
+		problems.append((n_qty[n_grp], e_qty[e_grp], margin))
+
+	for (n_grp, e_grp, piece_price), (i, j, qty) in zip(groups, _solve_all(problems, workers)):
+		shares.extend(n_grp[i], e_grp[j], qty)
+		if progress:
+			progress.add(len(n_grp), qty.sum() * piece_price)
+
+	n_row, e_row, qty = shares.arrays()
+	share_cost = qty * cost[n_plant[n_row], e_plant[e_row]]
+	return build_shares(needs_df, excess_df, price, plants, materials, n_row, e_row, qty, share_cost)
+
+def _group_rows(mat, qty, price, n_materials):
+	# Rows with something to share & a positive price, grouped by material in
+	# original row order
+	rows = np.flatnonzero((qty > 0) & (price[mat] > 0))
+	rows = rows[np.argsort(mat[rows], kind="stable")]
+	return rows, np.bincount(mat[rows], minlength=n_materials)
+
+def _material_pairs(n_rows, e_rows, n_mat, n_cnt, e_cnt):
+	'''
+	Lists every (need row, excess row) pair within each material, so each
+	material's pairs form one contiguous, need-major block.
+	Takes 5 inputs:
+		n_rows, e_rows - Needs & excess rows, grouped by material code
+		n_mat - Material code for each needs row
+		n_cnt, e_cnt - Needs & excess rows per material code
+	Returns (need row, excess row) arrays.
+	'''
+	e_start = np.concatenate(([0], np.cumsum(e_cnt)))[:-1]
+	reps = e_cnt[n_mat[n_rows]]
+	offset = np.arange(reps.sum()) - np.repeat(np.cumsum(reps) - reps, reps)
+	pair_n = np.repeat(n_rows, reps)
+	pair_e = e_rows[np.repeat(e_start[n_mat[n_rows]], reps) + offset]
+	return pair_n, pair_e
+
+def _solve_all(problems, workers):
+	# Small problems are batched so each worker call carries a useful amount
+	if workers <= 1 or len(problems) < 2:
+		return _solve_batch(problems)
+
+	size = -(-len(problems) // (workers * 4))
+	batches = [problems[k:k + size] for k in range(0, len(problems), size)]
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		return [result for batch in pool.map(_solve_batch, batches) for result in batch]
+
+def _solve_batch(problems):
+	return [solve_transport(*problem) for problem in problems]
+
+def solve_transport(need, excess, margin):
+	'''
+	Solves one material's transportation problem: ship at most each need and at
+	most each excess, maximising total margin. Lanes with no margin are unused.
+	Takes 3 inputs:
+		need - Need quantity of each needs plant
+		excess - Excess quantity of each excess plant
+		margin - Piece price less transfer cost, indexed by [need, excess]
+	Returns (need index, excess index, share qty) arrays.
+	'''
+	if len(need) == 1 or len(excess) == 1:
+		# One side is a single plant, so fill its best-margin lanes first
+		flat = margin.ravel()
+		cap = excess if len(need) == 1 else need
+		total = need[0] if len(need) == 1 else excess[0]
+		order = np.argsort(-flat, kind="stable")
+		order = order[flat[order] > 0]
+		take = cap[order]
+
+		flow = np.zeros(len(flat))
+		flow[order] = np.clip(total - (np.cumsum(take) - take), 0, take)
+		flow = flow.reshape(margin.shape)
+	else:
+		flow = _solve_lp(need, excess, margin)
+
+	i, j = np.nonzero(flow > 0)
+	return i, j, flow[i, j]
+
+def _solve_lp(need, excess, margin):
+	from scipy.optimize import linprog
+	from scipy.sparse import coo_matrix
+
+	lanes = np.flatnonzero(margin.ravel() > 0)
+	flow = np.zeros(margin.size)
+	if not lanes.size:
+		return flow.reshape(margin.shape)
+
+	# One constraint row per needs plant, then one per excess plant
+	rows = np.concatenate((lanes // margin.shape[1], len(need) + lanes % margin.shape[1]))
+	cols = np.tile(np.arange(len(lanes)), 2)
+	constraints = coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(need) + len(excess), len(lanes)))
+
+	# Dual simplex returns a vertex, which is integral for whole quantities
+	result = linprog(
+		-margin.ravel()[lanes], A_ub=constraints, b_ub=np.concatenate((need, excess)),
+		bounds=(0, None), method="highs-ds"
+		)
+	if result.status != 0:
+		raise RuntimeError(f"Transfer optimisation failed: {result.message}")
+
+	x = result.x
+	snapped = np.round(x)
+	flow[lanes] = np.where(np.abs(x - snapped) < 1e-6, snapped, x)
+	return flow.reshape(margin.shape)
@@ -0,0 +1,162 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+
+def allocate_parallel(engine, n_mat, n_qty, e_mat, e_qty, price, workers, progress=None):
+	'''
+	Splits the allocation into partitions of whole materials, balanced by row
+	count, and runs each partition in its own process. A share only ever moves
+	one material, so the partial results can simply be joined back together.
+	The input columns are published once in shared memory and the workers write
+	their shares straight into a shared result buffer, so only a small
+	descriptor is pickled for each partition.
+	Takes 8 inputs:
+		engine - Allocation function to run on each partition (see ENGINES)
+		n_mat, n_qty - Material code & need quantity for each needs row
+		e_mat, e_qty - Material code & excess quantity for each excess row
+		price - Piece price, indexed by material code
+		workers - Maximum number of worker processes
+		progress - Optional Progress, updated as each partition finishes
+	Returns (need row, excess row, share qty) arrays, one entry per share.
+	'''
+	ranges = partition_materials(n_mat, e_mat, len(price), workers)
+	if len(ranges) <= 1:
+		return engine(n_mat, n_qty, e_mat, e_qty, price, progress)
+
+	# Order rows by material so each partition is a contiguous slice
+	n_order = np.argsort(n_mat, kind="stable")
+	e_order = np.argsort(e_mat, kind="stable")
+	n_sorted = n_mat[n_order]
+	e_sorted = e_mat[e_order]
+
+	# A material with n needs and e excess rows makes fewer than n + e shares,
+	# so each partition gets that much room in the result buffer
+	tasks = []
+	out_lo = 0
+	for m_lo, m_hi in ranges:
+		n_lo, n_hi = np.searchsorted(n_sorted, [m_lo, m_hi]).tolist()
+		e_lo, e_hi = np.searchsorted(e_sorted, [m_lo, m_hi]).tolist()
+		tasks.append((n_lo, n_hi, e_lo, e_hi, m_lo, m_hi, out_lo))
+		out_lo += (n_hi - n_lo) + (e_hi - e_lo)
+
+	blocks, descriptor = publish_arrays({
+		"n_mat": n_sorted,
+		"n_qty": n_qty[n_order].astype(float),
+		"e_mat": e_sorted,
+		"e_qty": e_qty[e_order].astype(float),
+		"price": price.astype(float),
+		"n_row": np.zeros(out_lo, dtype=np.int64),
+		"e_row": np.zeros(out_lo, dtype=np.int64),
+		"qty": np.zeros(out_lo, dtype=float)
+		})
+	if progress:
+		progress.add(len(n_mat) - sum(task[1] - task[0] for task in tasks))
+
+	try:
+		result = attach_arrays(descriptor, blocks)
+		counts = [0] * len(tasks)
+		with ProcessPoolExecutor(max_workers=len(tasks)) as pool:
+			futures = {pool.submit(_allocate_partition, engine, descriptor, task): p for p, task in enumerate(tasks)}
+			for future in as_completed(futures):
+				p = futures[future]
+				counts[p] = future.result()
+				if progress:
+					n_lo, n_hi, out_lo = tasks[p][0], tasks[p][1], tasks[p][-1]
+					slot = slice(out_lo, out_lo + counts[p])
+					progress.add(n_hi - n_lo, (result["qty"][slot] * price[n_sorted[result["n_row"][slot]]]).sum())
+
+		# Gather the filled part of each partition's slot, mapped back to the
+		# rows of the caller's arrays
+		keep = np.concatenate([np.arange(task[-1], task[-1] + count) for task, count in zip(tasks, counts)])
+		n_row = n_order[result["n_row"][keep]]
+		e_row = e_order[result["e_row"][keep]]
+		qty = result["qty"][keep]
+		del result
+	finally:
+		for shm in blocks:
+			shm.close()
+			shm.unlink()
+
+	return n_row, e_row, qty
+
+def publish_arrays(arrays):
+	'''
+	Copies arrays into new shared memory blocks.
+	Takes 1 input:
+		arrays - Dictionary of name: numpy array
+	Returns (blocks, descriptor), where descriptor maps each name to the
+	(block name, dtype, shape) needed to attach to it from another process.
+	The caller must close & unlink the blocks.
+	'''
+	blocks, descriptor = [], {}
+	for key, arr in arrays.items():
+		shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+		np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[:] = arr
+		blocks.append(shm)
+		descriptor[key] = (shm.name, arr.dtype.str, arr.shape)
+	return blocks, descriptor
+
+def attach_arrays(descriptor, blocks):
+	'''
+	Maps the arrays in a descriptor onto shared memory blocks.
+	Takes 2 inputs:
+		descriptor - Descriptor from publish_arrays
+		blocks - List to add the attached blocks to (the caller closes them)
+	Returns a dictionary of name: numpy array, backed by the shared blocks.
+	'''
+	attached = {shm.name: shm for shm in blocks}
+	arrays = {}
+	for key, (name, dtype, shape) in descriptor.items():
+		if name not in attached:
+			attached[name] = shared_memory.SharedMemory(name=name)
+			blocks.append(attached[name])
+		arrays[key] = np.ndarray(shape, dtype, buffer=attached[name].buf)
+	return arrays
+
+def _allocate_partition(engine, descriptor, task):
+	# Runs in a worker process: allocate one slice of the shared inputs and
+	# write the shares into this partition's slot of the result buffer
+	n_lo, n_hi, e_lo, e_hi, m_lo, m_hi, out_lo = task
+	blocks = []
+	arr = attach_arrays(descriptor, blocks)
+	try:
+		i, j, qty = engine(
+			arr["n_mat"][n_lo:n_hi] - m_lo, arr["n_qty"][n_lo:n_hi],
+			arr["e_mat"][e_lo:e_hi] - m_lo, arr["e_qty"][e_lo:e_hi],
+			arr["price"][m_lo:m_hi]
+			)
+		count = len(qty)
+		arr["n_row"][out_lo:out_lo + count] = i + n_lo
+		arr["e_row"][out_lo:out_lo + count] = j + e_lo
+		arr["qty"][out_lo:out_lo + count] = qty
+	finally:
+		del arr
+		for shm in blocks:
+			shm.close()
+	return count
+
+def partition_materials(n_mat, e_mat, n_materials, workers):
+	'''
+	Balances material codes across workers by row count. Only materials with
+	both needs and excess count, since the rest never generate a share.
+	Takes 4 inputs:
+		n_mat - Material code for each needs row
+		e_mat - Material code for each excess row
+		n_materials - Number of material codes
+		workers - Maximum number of partitions
+	Returns a list of (first code, end code) ranges, skipping empty ones.
+	'''
+	n_cnt = np.bincount(n_mat, minlength=n_materials)
+	e_cnt = np.bincount(e_mat, minlength=n_materials)
+	weight = np.where((n_cnt > 0) & (e_cnt > 0), n_cnt + e_cnt, 0)
+
+	cum = np.cumsum(weight)
+	if n_materials == 0 or cum[-1] == 0:
+		return []
+
+	targets = cum[-1] * np.arange(1, workers) / workers
+	bounds = np.unique(np.concatenate(([0], np.searchsorted(cum, targets, side="right"), [n_materials])))
+	return [
+		(lo, hi) for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist())
+		if weight[lo:hi].any()
+		]
@@ -0,0 +1,20 @@
+import numpy as np
+
+def piece_prices(material, bklg_qty, bklg_val, n_materials):
+	'''
+	Calculates the average backlog price of every material, summing backlog
+	quantity & value per material code with np.bincount. Materials with no
+	backlog quantity get a price of 0, since they have nothing to price from.
+	Takes 4 inputs:
+		material - Material code for each row
+		bklg_qty - Backlog quantity for each row
+		bklg_val - Backlog value for each row
+		n_materials - Number of material codes
+	Returns an array of piece prices, indexed by material code.
+	'''
+	qty = np.bincount(material, weights=np.nan_to_num(np.asarray(bklg_qty, dtype=float)), minlength=n_materials)
+	val = np.bincount(material, weights=np.nan_to_num(np.asarray(bklg_val, dtype=float)), minlength=n_materials)
+
+	price = np.zeros(n_materials)
+	np.divide(val, qty, out=price, where=qty != 0)
+	return price
@@ -0,0 +1,44 @@
+import time
+
+class Progress():
+	'''
+	Keeps running totals for an allocation run and reports them through a
+	callback. Updates are coalesced, so the callback only fires once the
+	interval has passed or progress has moved by the percentage step, plus a
+	guaranteed final report from finish().
+	Takes 4 inputs:
+		total - Number of needs to work through
+		callback - Function called with (needs left, revenue found)
+		interval - Minimum seconds between reports (None to ignore time)
+		step - Percentage of the needs that forces a report (None to ignore)
+	'''
+
+	def __init__(self, total, callback, interval=0.1, step=1):
+		self.total = total
+		self.callback = callback
+		self.interval = interval
+		self.step = step
+		self.done = 0
+		self.revenue = 0.0
+		self.last_time = time.monotonic()
+		self.last_done = 0
+
+	def add(self, done=0, revenue=0.0):
+		# Add to the running totals, reporting only when due
+		self.done += done
+		self.revenue += revenue
+
+		if self.interval is not None and time.monotonic() - self.last_time >= self.interval:
+			self.report()
+		elif self.step is not None and 100 * (self.done - self.last_done) >= self.step * self.total:
+			self.report()
+
+	def report(self):
+		self.callback(self.total - self.done, self.revenue)
+		self.last_time = time.monotonic()
+		self.last_done = self.done
+
+	def finish(self):
+		# Every need has been searched once the run is over
+		self.done = self.total
+		self.report()
@@ -0,0 +1,83 @@
+import glob
+import hashlib
+import os
+import pandas as pd
+
+from modules.allocation import ENGINE_VERSION
+
+def file_fingerprint(filename, chunk_size=2**20):
+	'''
+	Hashes the contents of a file.
+	Takes 2 inputs:
+		filename - File to hash
+		chunk_size - Bytes to read at a time
+	Returns the hex digest.
+	'''
+	h = hashlib.blake2b(digest_size=16)
+	with open(filename, "rb") as f:
+		for chunk in iter(lambda: f.read(chunk_size), b""):
+			h.update(chunk)
+	return h.hexdigest()
+
+def run_key(fingerprint, options):
+	'''
+	Combines an input fingerprint, the run options and the engine version into
+	a result cache key.
+	Takes 2 inputs:
+		fingerprint - Fingerprint of the input file(s)
+		options - Tuple of the options that change the results
+	Returns the key as a hex string.
+	'''
+	h = hashlib.blake2b(digest_size=16)
+	h.update(repr((fingerprint, options, ENGINE_VERSION)).encode())
+	return h.hexdigest()
+
+class ResultCache():
+	'''
+	Folder of finished shares tables stored as Feather files, one per run key.
+	The least recently used files are removed once the folder grows past
+	max_bytes.
+	Takes 2 inputs:
+		folder - Folder to keep the cached tables in (created if missing)
+		max_bytes - Size limit for the folder
+	'''
+
+	def __init__(self, folder, max_bytes=1 * 2**30):
+		self.folder = folder
+		self.max_bytes = max_bytes
+		os.makedirs(folder, exist_ok=True)
+
+	def path(self, key):
+		return os.path.join(self.folder, key + ".feather")
+
+	def get(self, key):
+		# Returns the cached shares dataframe, or None if the key isn't cached
+		# A corrupt file raises ArrowInvalid, a ValueError, and counts as a miss
+		path = self.path(key)
+		try:
+			shares = pd.read_feather(path)
+			os.utime(path)
+		except (OSError, ImportError, ValueError):
+			return None
+		return shares
+
+	def put(self, key, shares):
+		# Writes to a temporary file first, so a failed write never leaves a
+		# partial table behind
+		path = self.path(key)
+		shares.reset_index(drop=True).to_feather(path + ".tmp")
+		os.replace(path + ".tmp", path)
+		self.evict()
+
+	def evict(self):
+		files = sorted(glob.glob(os.path.join(self.folder, "*.feather")), key=os.path.getmtime)
+		total = sum(os.path.getsize(f) for f in files)
+		for f in files:
+			if total <= self.max_bytes:
+				break
+			total -= os.path.getsize(f)
+			os.remove(f)
+
+	def purge(self):
+		for f in glob.glob(os.path.join(self.folder, "*.feather*")):
+			os.remove(f)
@@ -0,0 +1,104 @@
+import pandas as pd
+import numpy as np
+
+TEMPLATE_COLUMNS = ['material', 'plant', 'invy', 'bklg_qty', 'bklg_val']
+
+# Keys are read as text, so material 12345 and "12345" are the same part
+TEMPLATE_DTYPES = {
+	'material': str,
+	'plant': str,
+	'invy': np.float64,
+	'bklg_qty': np.float64,
+	'bklg_val': np.float64
+	}
+
+ERROR_COLUMNS = ['Row', 'Column', 'Error', 'Value']
+
+# Reported, but the row is kept with its backlog value blanked
+STRAY_VALUE_ERROR = 'Backlog value without backlog qty'
+
+def match_columns(names):
+	'''
+	Matches a file's column names to the template, ignoring case & surrounding
+	spaces, so "Material " and "BKLG_QTY" are accepted in any order.
+	Takes 1 input:
+		names - Column names from the file
+	Returns {file column name: template column name}, first match winning.
+	'''
+	matched = {}
+	for name in names:
+		col = str(name).strip().lower()
+		if col in TEMPLATE_COLUMNS and col not in matched.values():
+			matched[name] = col
+	return matched
+
+def validate(df, first_row=0):
+	'''
+	Coerces the template columns to their dtypes in bulk and checks every row
+	with vectorized masks. Rows with a problem are reported and left out:
+	missing plant or material, a non-numeric quantity or value, or negative
+	inventory. A backlog value with no backlog quantity is reported too, but
+	only the value is blanked and the row is kept.
+	Takes 2 inputs:
+		df - Dataframe with the template columns, as read from the file
+		first_row - Position of the first row in the file, for chunked reads
+	Returns (clean dataframe, error report). The report has one line per
+	problem, with the spreadsheet row (header is row 1), column, error &
+	offending value.
+	'''
+	clean = {}
+	problems = []
+	for col, dtype in TEMPLATE_DTYPES.items():
+		values = df[col]
+		if dtype is str:
+			text = _key_text(values)
+			blank = values.isna() | text.eq("")
+			clean[col] = text.where(~blank)
+			problems.append((col, "Missing " + col, blank.to_numpy()))
+		else:
+			number = values if values.dtype.kind in "fiub" else pd.to_numeric(values, errors="coerce")
+			number = number.astype(np.float64)
+
+			# Only values that failed to convert can be blank text
+			blank = values.isna()
+			odd = ~blank & number.isna()
+			if odd.any():
+				blank[odd] = values[odd].astype(str).str.strip().eq("").to_numpy(dtype=bool)
+			clean[col] = number
+			problems.append((col, "Non-numeric " + col, (~blank & number.isna()).to_numpy()))
+
+	clean = pd.DataFrame(clean, index=df.index)
+	problems.append(("invy", "Negative inventory", (clean["invy"] < 0).to_numpy()))
+	bad = np.logical_or.reduce([mask for _, _, mask in problems])
+
+	# A stray backlog value only spoils the value, so the row & its inventory
+	# are kept with the value blanked, leaving it out of the piece price
+	no_qty = clean["bklg_qty"].fillna(0) == 0
+	stray = (no_qty & (clean["bklg_val"].fillna(0) != 0)).to_numpy()
+	clean.loc[stray, "bklg_val"] = np.nan
+	problems.append(("bklg_val", STRAY_VALUE_ERROR, stray))
+
+	reports = []
+	for col, error, mask in problems:
+		rows = np.flatnonzero(mask)
+		values = df[col].iloc[rows]
+		reports.append(pd.DataFrame({
+			'Row': first_row + rows + 2,
+			'Column': col,
+			'Error': error,
+			'Value': values.astype(str).where(values.notna(), "").to_numpy()
+			}))
+
+	errors = pd.concat(reports, ignore_index=True).sort_values(['Row', 'Column'], kind="stable", ignore_index=True)
+	return clean[~bad], errors
+
+def _key_text(values):
+	# Whole numbers read as floats lose their ".0", so 12345.0 matches "12345"
+	if values.dtype.kind == "f":
+		whole = values.notna() & (values % 1 == 0)
+		text = values.astype(str)
+		text[whole] = values[whole].astype(np.int64).astype(str)
+		return text
+	if values.dtype.kind in "iub":
+		return values.astype(str)
+	return values.astype(str).str.strip()
@@ -0,0 +1,188 @@
+import os
+import tempfile
+import pandas as pd
+import numpy as np
+
+from modules.import_file import read_chunks
+from modules.keys import plant_material_key
+from modules.piece_price import piece_prices
+from modules.schema import ERROR_COLUMNS, validate
+
+# Rough peak bytes per row while a chunk is parsed & coded
+CHUNK_ROW_BYTES = 400
+
+# Bytes per (plant, material) row of the running aggregate, allowing for the
+# copies made while merging a chunk into it
+AGGREGATE_ROW_BYTES = 160
+
+# Spill files the aggregate is split into, by material code
+SPILL_PARTITIONS = 64
+
+SPILL_RECORD = np.dtype([
+	("plant", "<i4"), ("material", "<i4"), ("row", "<i8"),
+	("invy", "<f8"), ("bklg_qty", "<f8"), ("bklg_val", "<f8")
+	])
+
+VALUE_COLUMNS = ["invy", "bklg_qty", "bklg_val"]
+
+def stream_import(filenames, budget, spill_dir=None, status=None):
+	'''
+	Imports files too large to load whole, one after another. Chunks are coded and their
+	duplicate (plant, material) rows summed as they are read, so only one row
+	per (plant, material) is kept, alongside per-material backlog totals for
+	the piece prices. A quarter of the budget goes to each chunk; once the
+	aggregate outgrows half the budget it is spilled to disk, split by
+	material, and each part is summed separately at the end.
+	Takes 4 inputs:
+		filenames - Paths of excel, csv, parquet or feather files with every
+			template column
+		budget - Memory budget in bytes
+		spill_dir - Folder for the spill files (the system temp folder if None)
+		status - Optional function called with progress messages
+	Each chunk goes through validate, and rows with a problem are left out.
+	Returns (needs_df, excess_df, plants, materials, piece prices, rows read,
+	error report). The error report has a "File" column on top of validate's.
+	The needs & excess dataframes hold "material", "plant" & "need"/"excess"
+	codes in first-seen row order, indexed by the "plant_material" key.
+	'''
+	chunk_rows = max(budget // 4 // CHUNK_ROW_BYTES, 1000)
+	max_groups = max(budget // 2 // AGGREGATE_ROW_BYTES, 1000)
+
+	plants = {}
+	materials = {}
+	bklg_qty = np.zeros(0)
+	bklg_val = np.zeros(0)
+	aggregate = _empty_records()
+	rows_read = 0
+	kept = 0
+
+	if spill_dir is not None:
+		os.makedirs(spill_dir, exist_ok=True)
+	with tempfile.TemporaryDirectory(dir=spill_dir) as folder:
+		spilled = False
+		errors = []
+		for filename in filenames:
+			file_rows = 0
+			for chunk in read_chunks(filename, chunk_rows):
+				size = len(chunk.index)
+				chunk, chunk_errors = validate(chunk, file_rows)
+				errors.append(chunk_errors.assign(File=os.path.basename(filename)))
+				records = _code_chunk(chunk, plants, materials, rows_read)
+				kept += len(records)
+				file_rows += size
+				rows_read += size
+				del chunk
+
+				# Backlog totals per material, for the piece prices
+				bklg_qty = _grow(bklg_qty, len(materials))
+				bklg_val = _grow(bklg_val, len(materials))
+				bklg_qty += np.bincount(records["material"], np.nan_to_num(records["bklg_qty"]), len(materials))
+				bklg_val += np.bincount(records["material"], np.nan_to_num(records["bklg_val"]), len(materials))
+
+				aggregate = _sum_duplicates(np.concatenate((aggregate, records)))
+				if len(aggregate) > max_groups:
+					_spill(aggregate, folder)
+					aggregate = _empty_records()
+					spilled = True
+				if status:
+					status(f"Read {rows_read:,} rows ({len(plants):,} plants, {len(materials):,} materials)...")
+
+		# Sum each material partition on its own, keeping only needs & excess
+		needs, excess = [], []
+		groups = 0
+		parts = range(SPILL_PARTITIONS) if spilled else [None]
+		for part in parts:
+			records = aggregate
+			if part is not None:
+				records = records[records["material"] % SPILL_PARTITIONS == part]
+				path = os.path.join(folder, f"{part}.bin")
+				if os.path.exists(path):
+					records = np.concatenate((np.fromfile(path, SPILL_RECORD), records))
+				records = _sum_duplicates(records)
+			groups += len(records)
+			need = records["bklg_qty"] - records["invy"]
+			needs.append(records[need > 0])
+			excess.append(records[need < 0])
+		del aggregate
+
+	if status:
+		status(f"Merged {kept - groups:,} duplicate plant/material rows.")
+	n_materials = len(materials)
+	prices = piece_prices(np.arange(n_materials), bklg_qty, bklg_val, n_materials)
+	needs_df = _split_frame(np.concatenate(needs), "need", n_materials)
+	excess_df = _split_frame(np.concatenate(excess), "excess", n_materials)
+	errors = pd.concat(errors, ignore_index=True) if errors else pd.DataFrame(columns=ERROR_COLUMNS + ["File"])
+	return needs_df, excess_df, pd.Index(list(plants)), pd.Index(list(materials)), prices, rows_read, errors
+
+def _empty_records():
+	return np.empty(0, dtype=SPILL_RECORD)
+
+def _grow(totals, size):
+	return np.concatenate((totals, np.zeros(size - len(totals))))
+
+def _code_chunk(chunk, plants, materials, first_row):
+	'''
+	Codes a chunk's plants & materials, adding new labels to the running
+	lookups. Rows missing a plant or material are dropped, as in encode_keys.
+	Takes 4 inputs:
+		chunk - Dataframe with the template columns
+		plants, materials - Dicts of label -> code, updated in place
+		first_row - Row number of the chunk's first row, counting every file
+	Returns an array of SPILL_RECORD records.
+	'''
+	records = np.empty(len(chunk), dtype=SPILL_RECORD)
+	found = np.ones(len(chunk), dtype=bool)
+	for col, lookup in (("plant", plants), ("material", materials)):
+		codes, labels = pd.factorize(chunk[col])
+		label_codes = np.array([lookup.setdefault(label, len(lookup)) for label in labels], dtype=np.int32)
+		records[col] = np.where(codes >= 0, label_codes[codes] if len(labels) else 0, -1)
+		found &= codes >= 0
+	records["row"] = first_row + chunk.index.to_numpy()
+	for col in VALUE_COLUMNS:
+		records[col] = chunk[col].to_numpy(dtype=float)
+	return records[found]
+
+def _sum_duplicates(records):
+	'''
+	Sums rows sharing a (plant, material), keeping the first row number. A
+	value stays missing only if it is missing on every duplicate.
+	Takes 1 input:
+		records - Array of SPILL_RECORD records
+	Returns an array of SPILL_RECORD records, one per (plant, material).
+	'''
+	# Sorting by row first makes np.unique pick each key's first row
+	records = records[np.argsort(records["row"], kind="stable")]
+	key = records["plant"].astype(np.int64) << 32 | records["material"].astype(np.int64)
+	_, first, inverse = np.unique(key, return_index=True, return_inverse=True)
+	if len(first) == len(records):
+		return records
+
+	summed = records[first]
+	for col in VALUE_COLUMNS:
+		values = records[col]
+		known = ~np.isnan(values)
+		total = np.bincount(inverse, np.where(known, values, 0), len(first))
+		summed[col] = np.where(np.bincount(inverse, known, len(first)) > 0, total, np.nan)
+	return summed
+
+def _spill(records, folder):
+	# Appends each material partition to its own file
+	part = records["material"] % SPILL_PARTITIONS
+	order = np.argsort(part, kind="stable")
+	bounds = np.searchsorted(part[order], np.arange(SPILL_PARTITIONS + 1))
+	for p in range(SPILL_PARTITIONS):
+		if bounds[p] < bounds[p + 1]:
+			with open(os.path.join(folder, f"{p}.bin"), "ab") as f:
+				records[order[bounds[p]:bounds[p + 1]]].tofile(f)
+
+def _split_frame(records, field, n_materials):
+	# Needs or excess rows in first-seen order, as the full import has them
+	records = records[np.argsort(records["row"], kind="stable")]
+	qty = records["bklg_qty"] - records["invy"]
+	df = pd.DataFrame({
+		"material": records["material"],
+		"plant": records["plant"],
+		field: qty if field == "need" else -qty
+		})
+	df.index = plant_material_key(df["plant"], df["material"], n_materials)
+	return df